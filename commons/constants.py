@@ -3,6 +3,9 @@ ENV_SHEET_ID = 'SHEET_ID'
 ENV_SHEET_NAME = 'SHEET_NAME'
 ENV_SHEET_NAME_POST_REVIEW = 'SHEET_NAME_POST_REVIEW'
 ENV_POSTGRES_CONNECTION_STRING = 'POSTGRES_CONNECTION_STRING'
+ENV_WEBHOOK_URL = 'WEBHOOK_URL'
+ENV_WEBHOOK_SECRET = 'WEBHOOK_SECRET'
+ENV_WEBHOOK_PORT = 'WEBHOOK_PORT'
 CMD_START = "start"
 CMD_CHECK = "check"
 CMD_AUTHORIZE = "authorize"
@@ -93,9 +96,6 @@ KEY_USER_SHARE = "user_share"
 
 CONFIG_LAST_PROCESSED_ROW = "last_processed_row"
 CONFIG_USER_IDS = "user_ids"
-CONTEXT_TRANSACTION = "transaction"
-CONTEXT_CONVERSATION_STATE = "conversation_state"
-CONTEXT_RELATED_MESSAGE_IDS = "related_message_ids"
 
 BTN_SHARED_EXPENSE = "Shared Expense"
 BTN_SOLO_EXPENSE = "Solo Expense"
@@ -106,7 +106,15 @@ DEFAULT_LAST_PROCESSED_ROW = 0
 DEBANIKS_USER_ID = 6585093194
 BUTTONS_PER_ROW = 2
 CHECK_INTERVAL_SECONDS = 5
+MAX_CHECK_INTERVAL_SECONDS = 60
 FIRST_CHECK_DELAY_SECONDS = 10
+CONFIG_FLUSH_DELAY_SECONDS = 0.5
+MAX_OPEN_CONVERSATIONS = 10_000
+CONVERSATION_TTL_SECONDS = 7 * 24 * 60 * 60
+CONVERSATION_SWEEP_INTERVAL_SECONDS = 60 * 60
+WEBHOOK_LISTEN_ADDRESS = '0.0.0.0'
+DEFAULT_WEBHOOK_PORT = 8443
+WEBHOOK_URL_PATH = 'telegram'
 HTML_PARSE_MODE = 'HTML'
 SHARED_TYPE = 'Shared'
 SOLO_TYPE = 'Solo'
\ No newline at end of file
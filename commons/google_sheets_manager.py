@@ -1,10 +1,15 @@
 import logging
-from typing import List, Tuple, Dict
+import threading
+from typing import List, Tuple, Dict, Set, Any
 
 import gspread
 from google.auth.exceptions import GoogleAuthError
+from google.auth.transport.requests import AuthorizedSession
 from google.oauth2.service_account import Credentials
 from gspread import WorksheetNotFound
+from gspread.utils import rowcol_to_a1
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from constants import KEY_TRANSACTION_ID, KEY_DATE, KEY_TIME, KEY_RECIPIENT, KEY_AMOUNT, KEY_BANK, KEY_MODE, \
     COL_CATEGORY, COL_IS_SHARED, COL_USER_SHARE, YES_VALUE, NO_VALUE, NA_VALUE, COL_BANK, COL_MODE, COL_AMOUNT, \
@@ -20,6 +25,20 @@ SCOPES = [
     'https://www.googleapis.com/auth/drive'
 ]
 
+# HTTP connection pooling for the long-lived Sheets session
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE = 20
+# Only idempotent requests are retried, so appends are never duplicated. The backoff is
+# exponential with jitter, capped, and yields to Retry-After so quota throttling can clear
+MAX_RETRIES = Retry(total=5, backoff_factor=1, backoff_max=30, backoff_jitter=1,
+                    status_forcelist=[429, 500, 502, 503, 504])
+
+RAW_HEADERS = [
+    COL_TRANSACTION_ID, COL_DATE, COL_TIME, COL_RECIPIENT, COL_AMOUNT,
+    COL_BANK, COL_MODE
+]
+REVIEWED_HEADERS = RAW_HEADERS + [COL_CATEGORY, COL_IS_SHARED, COL_USER_SHARE]
+
 
 class GoogleSheetsManager:
     """Class for monitoring and interacting with Google Sheets"""
@@ -33,6 +52,13 @@ class GoogleSheetsManager:
         self.client = None
         self.sheet = None
         self.write_sheet = None
+        self._raw_headers = []
+        self._raw_header_map = {}
+        self._review_headers = []
+        self._review_header_map = {}
+        # The bot polls and appends from different worker threads; header caches and reconnects
+        # rebind shared state, so they happen under this lock
+        self._lock = threading.RLock()
         self.connect()
 
     def create_sheet_if_not_exists(self, sheet_name: str):
@@ -44,16 +70,29 @@ class GoogleSheetsManager:
 
         return sheet
 
+    @staticmethod
+    def _build_session(credentials: Credentials) -> AuthorizedSession:
+        """Create an authorized session that keeps connections alive and retries transient errors"""
+        session = AuthorizedSession(credentials)
+        session.mount('https://', HTTPAdapter(
+            pool_connections=POOL_CONNECTIONS,
+            pool_maxsize=POOL_MAXSIZE,
+            max_retries=MAX_RETRIES
+        ))
+        return session
+
     def connect(self) -> None:
         """Establish connection to Google Sheets API"""
         try:
-            credentials = Credentials.from_service_account_file(
-                self.credentials_file, scopes=SCOPES
-            )
-            self.client = gspread.authorize(credentials)
-            self.spreadsheet = self.client.open_by_key(self.sheet_id)
-            self.sheet = self.create_sheet_if_not_exists(self.sheet_name)
-            self.write_sheet = self.create_sheet_if_not_exists(self.write_sheet_name)
+            with self._lock:
+                credentials = Credentials.from_service_account_file(
+                    self.credentials_file, scopes=SCOPES
+                )
+                self.client = gspread.Client(auth=credentials, session=self._build_session(credentials))
+                self.spreadsheet = self.client.open_by_key(self.sheet_id)
+                self.sheet = self.create_sheet_if_not_exists(self.sheet_name)
+                self.write_sheet = self.create_sheet_if_not_exists(self.write_sheet_name)
+                self._load_headers()
             logger.info("Successfully connected to Google Sheets")
         except GoogleAuthError as e:
             logger.error(f"Authentication error: {e}")
@@ -62,6 +101,38 @@ class GoogleSheetsManager:
             logger.error(f"Failed to connect to Google Sheets: {e}")
             raise
 
+    def _load_headers(self) -> None:
+        """Fetch and cache the header row of the raw and reviewed sheets"""
+        with self._lock:
+            self._raw_headers = self.sheet.row_values(1)
+            self._raw_header_map = {header: index for index, header in enumerate(self._raw_headers)}
+            self._review_headers = self.write_sheet.row_values(1)
+            self._review_header_map = {header: index for index, header in enumerate(self._review_headers)}
+
+    @staticmethod
+    def _ensure_headers(sheet, headers: List[str], header_map: Dict[str, int], expected_headers: List[str]) -> None:
+        """Append any missing expected headers in a single range update and extend the cached layout"""
+        missing = [header for header in expected_headers if header not in header_map]
+        if not missing:
+            return
+
+        start = rowcol_to_a1(1, len(headers) + 1)
+        end = rowcol_to_a1(1, len(headers) + len(missing))
+        sheet.update(range_name=f"{start}:{end}", values=[missing], value_input_option="RAW")
+
+        for header in missing:
+            header_map[header] = len(headers)
+            headers.append(header)
+
+    def load_known_transaction_ids(self) -> Set[str]:
+        """Fetch the ids of all transactions already in the raw sheet with a single column read"""
+        if COL_TRANSACTION_ID not in self._raw_header_map:
+            return set()
+
+        # col_values is 1-indexed; skip the header cell
+        column = self.sheet.col_values(self._raw_header_map[COL_TRANSACTION_ID] + 1)
+        return set(column[1:])
+
     def get_rows(self) -> List[List[str]]:
         """Get all rows from the sheet"""
         try:
@@ -71,6 +142,25 @@ class GoogleSheetsManager:
             self.connect()  # Try reconnecting
             return self.sheet.get_all_values()
 
+    def get_rows_after(self, row_index: int, column_count: int) -> List[List[str]]:
+        """
+        Get the rows that follow the given row index, padded to column_count cells
+
+        Only the tail of the sheet is requested, so the payload grows with the
+        number of new rows rather than the size of the sheet.
+        """
+        # Row indices are 0-based with the header at 0, A1 rows are 1-based
+        range_name = f"A{row_index + 2}:{rowcol_to_a1(1, column_count)[:-1]}"
+        try:
+            rows = self.sheet.get(range_name)
+        except Exception as e:
+            logger.error(f"Failed to get rows from sheet: {e}")
+            self.connect()  # Try reconnecting
+            rows = self.sheet.get(range_name)
+
+        # Unlike get_all_values, ranged reads drop trailing empty cells
+        return [row + [""] * (column_count - len(row)) for row in rows]
+
     def get_new_rows(self, last_processed_row: int) -> Tuple[List[Dict[str, str]], int]:
         """
         Get new rows added since the last check
@@ -82,20 +172,30 @@ class GoogleSheetsManager:
             Tuple containing list of new rows as dictionaries and the new last processed row index
         """
         try:
-            rows = self.get_rows()
-            if not rows:
-                return [], last_processed_row
-
-            headers = rows[0]
             min_expected_columns = 7  # Adjust based on expected number of columns
+
+            if last_processed_row > 0:
+                # Header layout is cached on connect, so only the unseen rows need fetching
+                with self._lock:
+                    if len(self._raw_headers) < min_expected_columns:
+                        self._load_headers()  # Headers may have been written since we connected
+                    headers = self._raw_headers
+                first_row_index = last_processed_row + 1
+                rows = self.get_rows_after(last_processed_row, min_expected_columns)
+            else:
+                rows = self.get_rows()
+                if not rows:
+                    return [], last_processed_row
+                headers = rows[0]
+                first_row_index = 1
+                rows = rows[1:]
+
             if len(headers) < min_expected_columns:
                 logger.error(f"Sheet doesn't have expected columns. Found: {headers}")
                 return [], last_processed_row
 
             new_rows = []
-            # Start from the row after the last processed one, skipping header
-            for i in range(max(1, last_processed_row + 1), len(rows)):
-                row = rows[i]
+            for row in rows:
                 if len(row) >= min_expected_columns:  # Ensure the row has all required fields
                     row_dict = {
                         KEY_TRANSACTION_ID: row[0],
@@ -109,7 +209,7 @@ class GoogleSheetsManager:
                     new_rows.append(row_dict)
 
             if new_rows:
-                new_last_processed_row = len(rows) - 1
+                new_last_processed_row = first_row_index + len(rows) - 1
             else:
                 new_last_processed_row = last_processed_row
 
@@ -128,85 +228,94 @@ class GoogleSheetsManager:
         Returns:
             True if the write was successful, False otherwise.
         """
+        return self.add_reviewed_transactions([transaction])
+
+    def add_reviewed_transactions(self, transactions: List[Transaction]) -> bool:
+        """
+        Append reviewed transactions to the Google Sheet in a single API call.
+
+        Args:
+            transactions: Transaction objects containing all transaction details.
+
+        Returns:
+            True if the write was successful, False otherwise.
+        """
+        if not transactions:
+            return True
+
         try:
-            # Get existing headers
-            headers = self.write_sheet.row_values(1)
-
-            # Define expected headers and values
-            expected_headers = [
-                COL_TRANSACTION_ID, COL_DATE, COL_TIME, COL_RECIPIENT, COL_AMOUNT,
-                COL_BANK, COL_MODE, COL_CATEGORY, COL_IS_SHARED, COL_USER_SHARE
-            ]
-            header_map = {header: index for index, header in enumerate(headers)}
-
-            # Add any missing headers
-            for idx, expected_header in enumerate(expected_headers):
-                if expected_header not in header_map:
-                    self.write_sheet.update_cell(1, len(headers) + 1, expected_header)
-                    headers.append(expected_header)
-                    header_map[expected_header] = len(headers) - 1
-
-            # Build row in correct order
-            row = [object()] * len(headers)
-            row[header_map[COL_TRANSACTION_ID]] = transaction.transaction_id
-            row[header_map[COL_DATE]] = transaction.date
-            row[header_map[COL_TIME]] = transaction.time
-            row[header_map[COL_RECIPIENT]] = transaction.recipient
-            row[header_map[COL_AMOUNT]] = transaction.amount
-            row[header_map[COL_BANK]] = transaction.bank
-            row[header_map[COL_MODE]] = transaction.mode
-            row[header_map[COL_CATEGORY]] = transaction.category
-            row[header_map[COL_IS_SHARED]] = YES_VALUE if transaction.is_shared else NO_VALUE
-            row[header_map[COL_USER_SHARE]] = transaction.user_share
-
-            # Append the row
-            self.write_sheet.append_row(row)
+            with self._lock:
+                self._ensure_headers(self.write_sheet, self._review_headers, self._review_header_map,
+                                     REVIEWED_HEADERS)
+                review_headers = tuple(self._review_headers)
+
+            rows = []
+            for transaction in transactions:
+                # Build row in header order; columns we don't own are left blank
+                values = self._raw_values(transaction)
+                values.update({
+                    COL_AMOUNT: transaction.amount,
+                    COL_CATEGORY: transaction.category,
+                    COL_IS_SHARED: YES_VALUE if transaction.is_shared else NO_VALUE,
+                    COL_USER_SHARE: transaction.user_share
+                })
+                rows.append([values.get(header, "") for header in review_headers])
+
+            # Append the rows
+            self.write_sheet.append_rows(rows)
             return True
         except Exception as e:
-            logger.error(f"Failed to write transaction: {e}")
+            logger.error(f"Failed to write {len(transactions)} transactions: {e}")
             return False
 
-    def add_raw_transaction(self, transaction: Transaction) -> bool:
+    @staticmethod
+    def _raw_values(transaction: Transaction) -> Dict[str, Any]:
+        """Map raw sheet column names to the transaction's values"""
+        return {
+            COL_TRANSACTION_ID: transaction.transaction_id,
+            COL_DATE: transaction.date,
+            COL_TIME: transaction.time,
+            COL_RECIPIENT: transaction.recipient,
+            COL_AMOUNT: str(transaction.amount),
+            COL_BANK: transaction.bank,
+            COL_MODE: transaction.mode
+        }
+
+    def build_raw_transaction_row(self, transaction: Transaction) -> List[str]:
         """
-        Append a new transaction to the Google Sheet.
+        Build a row for the raw transactions sheet without writing it.
 
         Args:
             transaction: A Transaction object containing all transaction details.
 
+        Returns:
+            The row values ordered to match the sheet headers.
+        """
+        with self._lock:
+            self._ensure_headers(self.sheet, self._raw_headers, self._raw_header_map, RAW_HEADERS)
+            raw_headers = tuple(self._raw_headers)
+
+        # Build row in header order; columns we don't own are left blank
+        values = self._raw_values(transaction)
+        row = [values.get(header, "") for header in raw_headers]
+        return row
+
+    def flush_raw_transactions(self, rows: List[List[str]]) -> bool:
+        """
+        Append a batch of rows to the raw transactions sheet in a single API call.
+
+        Args:
+            rows: Rows built with build_raw_transaction_row.
+
         Returns:
             True if the write was successful, False otherwise.
         """
+        if not rows:
+            return True
+
         try:
-            # Get existing headers
-            headers = self.sheet.row_values(1)
-
-            # Define expected headers and values
-            expected_headers = [
-                COL_TRANSACTION_ID, COL_DATE, COL_TIME, COL_RECIPIENT, COL_AMOUNT,
-                COL_BANK, COL_MODE
-            ]
-            header_map = {header: index for index, header in enumerate(headers)}
-
-            # Add any missing headers
-            for idx, expected_header in enumerate(expected_headers):
-                if expected_header not in header_map:
-                    self.sheet.update_cell(1, len(headers) + 1, expected_header)
-                    headers.append(expected_header)
-                    header_map[expected_header] = len(headers) - 1
-
-            # Build row in correct order
-            row = [""] * len(headers)
-            row[header_map[COL_TRANSACTION_ID]] = transaction.transaction_id
-            row[header_map[COL_DATE]] = transaction.date
-            row[header_map[COL_TIME]] = transaction.time
-            row[header_map[COL_RECIPIENT]] = transaction.recipient
-            row[header_map[COL_AMOUNT]] = str(transaction.amount)
-            row[header_map[COL_BANK]] = transaction.bank
-            row[header_map[COL_MODE]] = transaction.mode
-
-            # Append the row
-            self.sheet.append_row(row)
+            self.sheet.append_rows(rows, value_input_option='RAW')
             return True
         except Exception as e:
-            logger.error(f"Failed to write transaction: {e}")
+            logger.error(f"Failed to write {len(rows)} transactions: {e}")
             return False
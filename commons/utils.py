@@ -1,16 +1,24 @@
 import hashlib
+from typing import Optional
 
 
 def get_fingerprint_for_transaction(date, recipient, amount, bank):
     return f"{date}|{recipient}|{amount}|{bank}"
 
 
-def generate_transaction_id(fingerprint):
-    fingerprint_bytes = fingerprint.encode('utf-8')
-    md5_hash = hashlib.md5(fingerprint_bytes).digest()
-    return ''.join('{:02x}'.format(b) for b in md5_hash)
+def generate_transaction_digest(fingerprint) -> bytes:
+    # MD5 is kept so ids stay stable for rows already in the sheet; it is not used for security
+    return hashlib.md5(fingerprint.encode('utf-8'), usedforsecurity=False).digest()
 
 
-def get_transaction_id(date, recipient, amount, bank):
+def get_transaction_digest(date, recipient, amount, bank) -> bytes:
     fingerprint = get_fingerprint_for_transaction(date, recipient, amount, bank)
-    return generate_transaction_id(fingerprint)
+    return generate_transaction_digest(fingerprint)
+
+
+def transaction_id_to_digest(transaction_id: str) -> Optional[bytes]:
+    """Convert a hex transaction id back to its raw digest, or None if it isn't one"""
+    try:
+        return bytes.fromhex(transaction_id)
+    except ValueError:
+        return None
@@ -1,24 +1,37 @@
+import binascii
 import datetime
+import json
 import os
-import base64
-import email
-from typing import List
+from email import policy
+from email.parser import BytesParser
+from typing import List, Dict, Optional, Tuple
 
-from bs4 import BeautifulSoup
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from selectolax.parser import HTMLParser
 
-from commons.constants import ENV_SHEET_ID, ENV_SHEET_NAME, ENV_SHEET_NAME_POST_REVIEW
 from commons.google_sheets_manager import GoogleSheetsManager
-from env import TOKEN_PATH, GMAIL_OAUTH_CREDENTIALS_PATH
+from commons.utils import get_transaction_digest, transaction_id_to_digest
+from env import TOKEN_PATH, GMAIL_OAUTH_CREDENTIALS_PATH, SHEET_ID, SHEET_NAME, SHEET_NAME_POST_REVIEW
 from helpers import parse_cc_transaction, detect_bank, parse_upi_transaction
 from persistence.models import Transaction
-from utils import get_transaction_id
 
 # Scope for reading Gmail messages
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
+BATCH_MODIFY_MAX_IDS = 1000
+# Gmail allows up to 100 calls per batch but starts rate limiting above 50
+GMAIL_BATCH_SIZE = 50
+PROCESSED_LABEL_NAME = 'Processed'
+IMPORTER_STATE_FILE_NAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'importer_state.json')
+STATE_LAST_HISTORY_ID = 'last_history_id'
+# Maps the URL-safe base64 alphabet used by Gmail's raw format onto the standard one
+URLSAFE_TO_STANDARD_B64 = bytes.maketrans(b'-_', b'+/')
+
+# Label name -> label id, populated on the first label lookup
+_labels_cache: Dict[str, str] = {}
 
 
 # Authenticate with Google API
@@ -44,12 +57,36 @@ def authenticate():
     return build('gmail', 'v1', credentials=creds)
 
 
+def load_last_history_id():
+    if not os.path.exists(IMPORTER_STATE_FILE_NAME):
+        return None
+
+    with open(IMPORTER_STATE_FILE_NAME, 'r') as f:
+        return json.load(f).get(STATE_LAST_HISTORY_ID)
+
+
+def save_last_history_id(history_id):
+    with open(IMPORTER_STATE_FILE_NAME, 'w') as f:
+        json.dump({STATE_LAST_HISTORY_ID: history_id}, f, indent=2)
+
+
+def get_labels_by_name(service) -> Dict[str, str]:
+    # Fetch the mailbox labels once and serve later lookups from the cache
+    if not _labels_cache:
+        labels = service.users().labels().list(userId='me').execute().get('labels', [])
+        _labels_cache.update({label['name']: label['id'] for label in labels})
+    return _labels_cache
+
+
+def get_label_id_by_name(service, label_name):
+    return get_labels_by_name(service).get(label_name)
+
+
 def get_or_create_label_id_by_name(service, label_name):
     # Get existing labels
-    labels = service.users().labels().list(userId='me').execute().get('labels', [])
-    for label in labels:
-        if label['name'] == label_name:
-            return label['id']
+    label_id = get_label_id_by_name(service, label_name)
+    if label_id:
+        return label_id
 
     # Label not found, so create it
     label_body = {
@@ -58,6 +95,7 @@ def get_or_create_label_id_by_name(service, label_name):
         'messageListVisibility': 'show'
     }
     created_label = service.users().labels().create(userId='me', body=label_body).execute()
+    _labels_cache[label_name] = created_label['id']
     return created_label['id']
 
 
@@ -78,148 +116,275 @@ def convert_epoch_ms_to_datetime(epoch_ms: int):
     return dt.strftime('%Y-%m-%d %H:%M:%S')
 
 
+def get_part_text(part) -> str:
+    """Decode a MIME text part, falling back to UTF-8 when the declared charset is unknown"""
+    try:
+        return part.get_content()
+    except LookupError:
+        return part.get_payload(decode=True).decode(errors='replace')
+
+
 def extract_from_email(message):
     """
     Given a Gmail API message with format='raw', returns the decoded email body as plain text.
     If plain text is not found, falls back to HTML.
     """
     # Decode the raw message
-    raw_data = base64.urlsafe_b64decode(message['raw'].encode('UTF-8'))
-    mime_msg = email.message_from_bytes(raw_data)
-
-    text_body = None
-    html_body = None
-    sender = mime_msg['From'] if mime_msg['From'] else None
-
-    if mime_msg.is_multipart():
-        for part in mime_msg.walk():
-            content_type = part.get_content_type()
-            content_disposition = str(part.get("Content-Disposition"))
-
-            if "attachment" in content_disposition:
-                continue  # Skip attachments
-
-            payload = part.get_payload(decode=True)
-            if payload:
-                if content_type == "text/plain":
-                    text_body = payload.decode(errors='replace')
-                elif content_type == "text/html" and not html_body:
-                    html_body = payload.decode(errors='replace')
-    else:
-        # Non-multipart message
-        payload = mime_msg.get_payload(decode=True)
-        content_type = mime_msg.get_content_type()
-        if content_type == "text/plain":
-            text_body = payload.decode(errors='replace')
-        elif content_type == "text/html":
-            html_body = payload.decode(errors='replace')
-
-    if text_body:
-        return text_body, sender
-    elif html_body:
-        # Parse HTML to plain text
-        soup = BeautifulSoup(html_body, 'html.parser')
-        plain_text = soup.get_text(separator='\n')  # preserve some formatting with new lines
-        return plain_text, sender
-    else:
+    raw_data = binascii.a2b_base64(message['raw'].encode('ascii').translate(URLSAFE_TO_STANDARD_B64))
+    mime_msg = BytesParser(policy=policy.default).parsebytes(raw_data)
+
+    sender = mime_msg.get('From') or None
+
+    # get_body skips attachments and prefers the plain text alternative
+    body_part = mime_msg.get_body(preferencelist=('plain', 'html'))
+    if body_part is None:
         return "", sender
 
+    body = get_part_text(body_part)
+    if body_part.get_content_type() == 'text/html':
+        # Parse HTML to plain text
+        root = HTMLParser(body).root
+        body = root.text(separator='\n') if root else ""  # preserve some formatting with new lines
+
+    return body, sender
+
+
+def batch_get_messages(service, message_ids: List[str], **get_kwargs) -> Dict[str, dict]:
+    """
+    Fetch messages through Gmail batch requests instead of one HTTP call per message.
+
+    Returns:
+        dict: Message resources keyed by message id. Messages that failed to fetch are left out.
+    """
+    messages = {}
+
+    def on_message(request_id, response, exception):
+        if exception is not None:
+            print(f'Failed to fetch message {request_id}: {exception}')
+            return
+        messages[request_id] = response
+
+    # Request ids must be unique within a batch
+    unique_ids = list(dict.fromkeys(message_ids))
+    for start in range(0, len(unique_ids), GMAIL_BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=on_message)
+        for message_id in unique_ids[start:start + GMAIL_BATCH_SIZE]:
+            batch.add(service.users().messages().get(userId='me', id=message_id, **get_kwargs),
+                      request_id=message_id)
+        batch.execute()
+
+    return messages
+
+
+def get_messages_with_label_by_query(service, label_name):
+    messages = []
+    next_page_token = None
+    label_query = f'label:{label_name} -label:{PROCESSED_LABEL_NAME}'
+
+    while True:
+        response = service.users().messages().list(
+            userId='me',
+            q=label_query,
+            pageToken=next_page_token
+        ).execute()
+
+        messages.extend(response.get('messages', []))
+
+        next_page_token = response.get('nextPageToken')
+        if not next_page_token:
+            break
+
+    return messages
+
 
-def get_all_messages_with_labels(service, label_names: List[str]):
+def get_messages_with_label_since(service, label_id, start_history_id):
+    """
+    List messages that were added to the mailbox, or given the label, after start_history_id.
+
+    Raises:
+        HttpError: With status 404 if start_history_id is too old for Gmail to replay.
+    """
+    messages = []
+    next_page_token = None
+
+    while True:
+        response = service.users().history().list(
+            userId='me',
+            startHistoryId=start_history_id,
+            labelId=label_id,
+            historyTypes=['messageAdded', 'labelAdded'],
+            pageToken=next_page_token
+        ).execute()
+
+        for record in response.get('history', []):
+            for added in record.get('messagesAdded', []):
+                messages.append(added['message'])
+            for added in record.get('labelsAdded', []):
+                if label_id in added.get('labelIds', []):
+                    messages.append(added['message'])
+
+        next_page_token = response.get('nextPageToken')
+        if not next_page_token:
+            break
+
+    return messages
+
+
+def get_all_messages_with_labels(service, label_names: List[str], processed_label_id, start_history_id=None):
+    """
+    Collect the unprocessed messages carrying any of the given labels, oldest first.
+
+    With a start_history_id only the mailbox changes since that point are read instead
+    of re-listing every unprocessed message. If the history id has expired, this falls
+    back to the full label query.
+    """
     all_messages = []
 
     for label_name in label_names:
-        next_page_token = None
-        label_query = f'label:{label_name} -label:Processed'
-
-        while True:
-            response = service.users().messages().list(
-                userId='me',
-                q=label_query,
-                pageToken=next_page_token
-            ).execute()
-
-            messages = response.get('messages', [])
-            if not messages:
-                break
-
-            for msg in messages:
-                metadata = service.users().messages().get(
-                    userId='me',
-                    id=msg['id'],
-                    format='metadata'
-                ).execute()
-                msg['internalDate'] = int(metadata['internalDate'])
-                msg['label'] = label_name  # Associate label name with message
-                all_messages.append(msg)
-
-            next_page_token = response.get('nextPageToken')
-            if not next_page_token:
-                break
+        messages = None
+        if start_history_id:
+            label_id = get_label_id_by_name(service, label_name)
+            if not label_id:
+                continue
+            try:
+                messages = get_messages_with_label_since(service, label_id, start_history_id)
+            except HttpError as error:
+                if error.resp.status != 404:
+                    raise
+                print(f"History {start_history_id} is no longer available, listing all {label_name} messages")
+
+        if messages is None:
+            messages = get_messages_with_label_by_query(service, label_name)
+
+        seen_ids = set()
+        for msg in messages:
+            if msg['id'] in seen_ids:
+                continue
+            seen_ids.add(msg['id'])
+            all_messages.append({'id': msg['id'], 'label': label_name})  # Associate label name with message
+
+    # Only internalDate and labels are needed, so skip headers and trim the response with a fields mask
+    metadata = batch_get_messages(service, [msg['id'] for msg in all_messages],
+                                  format='minimal', fields='id,internalDate,labelIds')
+
+    unprocessed_messages = []
+    for msg in all_messages:
+        msg_metadata = metadata.get(msg['id'])
+        if not msg_metadata:
+            # Keep it so it is still attempted (and counted as failed) rather than silently dropped
+            msg['internalDate'] = 0
+        elif processed_label_id in msg_metadata.get('labelIds', []):
+            continue
+        else:
+            msg['internalDate'] = int(msg_metadata['internalDate'])
+        unprocessed_messages.append(msg)
 
     # Sort messages by internalDate (ascending = oldest first)
-    sorted_messages = sorted(all_messages, key=lambda x: x['internalDate'])
+    sorted_messages = sorted(unprocessed_messages, key=lambda x: x['internalDate'])
     return sorted_messages
 
 
+def mark_messages_as_processed(service, message_ids: List[str], processed_label_id: str):
+    # batchModify accepts at most 1000 ids per call
+    for start in range(0, len(message_ids), BATCH_MODIFY_MAX_IDS):
+        service.users().messages().batchModify(
+            userId='me',
+            body={'ids': message_ids[start:start + BATCH_MODIFY_MAX_IDS], 'addLabelIds': [processed_label_id]}
+        ).execute()
+
+
+def parse_message(message, parser_func) -> Optional[Tuple[bytes, Transaction]]:
+    """
+    Extract the transaction from a raw Gmail message without touching any external service.
+
+    Returns:
+        The transaction digest and Transaction, or None if the email isn't a completed transaction.
+    """
+    # Parse out the body
+    body, sender = extract_from_email(message)
+    email_date = convert_epoch_ms_to_datetime(int(message['internalDate']))
+    date_str, time_str = email_date.split(' ', 1)
+
+    # Detect the bank and parse
+    bank = detect_bank(sender, body)
+    parsed, mode = parser_func(bank, body)
+    if not parsed:
+        return None
+
+    recipient, amount = parsed["description"], parsed["amount"]
+    transaction_digest = get_transaction_digest(email_date, recipient, amount, bank)
+    return transaction_digest, Transaction(
+        transaction_digest.hex(),
+        date_str,
+        time_str,
+        recipient,
+        amount,
+        bank,
+        mode
+    )
+
+
 def process_emails(source_label_names: List[str], label_to_parser_func):
+    missing_parsers = [label for label in source_label_names if label not in label_to_parser_func]
+    if missing_parsers:
+        raise ValueError(f"No parser configured for labels: {missing_parsers}")
+
     service = authenticate()
-    gsheets_manager = GoogleSheetsManager(
-        os.environ.get(ENV_SHEET_ID),
-        os.environ.get(ENV_SHEET_NAME),
-        os.environ.get(ENV_SHEET_NAME_POST_REVIEW)
-    )
+    gsheets_manager = GoogleSheetsManager(SHEET_ID, SHEET_NAME, SHEET_NAME_POST_REVIEW)
 
-    processed_label_id = get_or_create_label_id_by_name(service, 'Processed')
-    threads = get_all_messages_with_labels(service, source_label_names)
+    processed_label_id = get_or_create_label_id_by_name(service, PROCESSED_LABEL_NAME)
 
-    # Mocking the spreadsheet (you can integrate it with Google Sheets API)
-    # Creating a simple dataframe to store processed transactions
-    transaction_ids = set()
+    # Captured before listing so that messages arriving mid-run are replayed next time
+    current_history_id = service.users().getProfile(userId='me').execute()['historyId']
+    threads = get_all_messages_with_labels(service, source_label_names, processed_label_id, load_last_history_id())
 
-    print(f"Found {len(threads)} transaction entries to process!")
+    # Rows are staged locally and appended in a single call once all messages are parsed
+    # Dedup on the raw 16 byte digests, which are half the size of the hex ids
+    known_digests = {transaction_id_to_digest(transaction_id)
+                     for transaction_id in gsheets_manager.load_known_transaction_ids()}
+    pending_rows = []
+    processed_message_ids = []
 
-    for thread in threads:
-        try:
-            message = service.users().messages().get(userId='me', id=thread['id'], format='raw').execute()
+    print(f"Found {len(threads)} transaction entries to process!")
 
-            # Parse out the body
-            body, sender = extract_from_email(message)
-            email_date = convert_epoch_ms_to_datetime(int(message['internalDate']))
+    raw_messages = batch_get_messages(service, [thread['id'] for thread in threads], format='raw')
 
-            # Detect the bank and parse
-            bank = detect_bank(sender, body)
-            parser_func = label_to_parser_func.get(thread['label'])
-            parsed, mode = parser_func(bank, body)
+    for thread in threads:
+        message = raw_messages.get(thread['id'])
+        if not message:
+            # Deleted or otherwise unavailable; it stays unlabelled, but must not hold back the history id
+            print(f"Message {thread['id']} could not be fetched. Skipping.")
+            continue
 
+        try:
+            parsed = parse_message(message, label_to_parser_func[thread['label']])
             if parsed:
-                recipient, amount = parsed["description"], parsed["amount"]
-                transaction_id = get_transaction_id(email_date, recipient, amount, bank)
-                if transaction_id not in transaction_ids:
-                    print(f"Processing: {bank}: {parsed}")
-                    gsheets_manager.add_raw_transaction(
-                        Transaction(
-                            transaction_id,
-                            email_date.split(' ')[0],
-                            email_date.split(' ')[1],
-                            recipient,
-                            amount,
-                            bank,
-                            mode
-                        )
-                    )
-                    transaction_ids.add(transaction_id)
+                transaction_digest, transaction = parsed
+                if transaction_digest not in known_digests:
+                    print(f"Processing: {transaction.bank}: {transaction.recipient} {transaction.amount}")
+                    pending_rows.append(gsheets_manager.build_raw_transaction_row(transaction))
+                    known_digests.add(transaction_digest)
                 else:
                     print("Entry already processed. Skipping.")
 
-            # Mark the thread as processed (use Gmail API to label it as 'Processed')
-            service.users().messages().modify(userId='me', id=message['id'],
-                                              body={'addLabelIds': [processed_label_id]}).execute()
+            processed_message_ids.append(message['id'])
 
         except Exception as error:
-            print(f'An error occurred: {error}')
+            # Left unlabelled, so a full listing still picks it up, without holding back the history id
+            print(f"An error occurred processing message {message['id']}: {error}")
+
+    if not gsheets_manager.flush_raw_transactions(pending_rows):
+        print("Failed to write transactions to the sheet. Leaving messages unprocessed.")
+        return
+
+    # Mark the messages as processed (use Gmail API to label them as 'Processed')
+    mark_messages_as_processed(service, processed_message_ids, processed_label_id)
+
+    # Every listed message has been labelled or logged as skipped, so the next run can start from here.
+    # Holding the id back for a single bad email would replay the same history on every run until Gmail
+    # expires it
+    save_last_history_id(current_history_id)
 
-    # Optionally: Save the data into Google Sheets using gspread or any other method
     print("Processing complete.")
 
 
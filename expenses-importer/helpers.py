@@ -1,62 +1,91 @@
 import re
+from typing import Dict, Pattern, Tuple
+
+# Bank parser patterns (amount, description), compiled once at import
+CC_PATTERNS: Dict[str, Tuple[Pattern, Pattern]] = {
+    "HDFC": (
+        re.compile(r'7883\s+for\s+(?:Rs\.?|INR)\s+([\d,]+(\.\d+)?)', re.I),
+        re.compile(r'at\s+(.*?)\s+on', re.I)
+    ),
+    "ICICI": (
+        re.compile(r'transaction\s+of\s+(?:Rs\.?|INR)\s+([\d,]+(\.\d+)?)', re.I),
+        re.compile(r'Info:\s+(.*?)\.', re.I)
+    ),
+    "HSBC": (
+        re.compile(r'been\s+used\s+for\s+(?:Rs\.?|INR)\s+([\d,]+(\.\d+)?)', re.I),
+        re.compile(r'payment to\s+(.*?)\s+on', re.I)
+    ),
+    "Axis": (
+        re.compile(r'9339\s+for\s+(?:Rs\.?|INR)\s+([\d,]+(\.\d+)?)', re.I),
+        re.compile(r'at\s+(.*?)\s+on', re.I)
+    ),
+    "Federal": (
+        re.compile(r'txn\s+of\s+(?:₹|Rs\.?|INR)\s*([\d,]+(\.\d+)?)', re.I),
+        re.compile(r'at\s+(.*?)\s+on', re.I)
+    ),
+}
+UPI_PATTERNS: Dict[str, Tuple[Pattern, Pattern]] = {
+    "Federal": (
+        re.compile(r'(?:₹|Rs\.?|INR|\b[A-Z]{3}\b)\s*([\d,]+(\.\d{1,})?)', re.I),
+        re.compile(r'to\s+(.*?)\.', re.I)
+    ),
+    "Kotak": (
+        re.compile(r'Sent\s+(?:₹|Rs\.?|INR|\b[A-Z]{3}\b)(.*?)\s+', re.I),
+        re.compile(r'to\s+(.*?)on', re.I)
+    ),
+}
+_FAILURE_RE = re.compile(r'has\s+been\s+reversed|declined|not\s+be\s+completed', re.I)
+
+MODE_CREDIT_CARD = "CreditCard"
+MODE_UPI = "UPI"
+
+
+# Lowercase bank name -> bank, in detection priority order
+BANK_NAMES = {
+    "hdfc": "HDFC",
+    "icici": "ICICI",
+    "hsbc": "HSBC",
+    "axis": "Axis",
+    "federal": "Federal",
+    "kotak": "Kotak",
+}
+_BANK_NAME_RE = re.compile('|'.join(BANK_NAMES), re.I)
+_BANK_IN_BODY_RE = re.compile(f"({'|'.join(BANK_NAMES)}) bank", re.I)
 
 
 # Function to detect the bank based on email sender
 def detect_bank(sender, body):
-    if 'hdfc' in sender.lower() or 'hdfc bank' in body.lower():
-        return "HDFC"
-    elif 'icici' in sender.lower() or 'icici bank' in body.lower():
-        return "ICICI"
-    elif 'hsbc' in sender.lower() or 'hsbc bank' in body.lower():
-        return "HSBC"
-    elif 'axis' in sender.lower() or 'axis bank' in body.lower():
-        return "Axis"
-    elif 'federal' in sender.lower() or 'federal bank' in body.lower():
-        return "Federal"
-    elif 'kotak' in sender.lower() or 'kotak bank' in body.lower():
-        return "Kotak"
+    # One scan per string instead of lowercasing and searching them once per bank
+    found = {name.lower() for name in _BANK_NAME_RE.findall(sender)}
+    found.update(name.lower() for name in _BANK_IN_BODY_RE.findall(body))
+
+    for name, bank in BANK_NAMES.items():
+        if name in found:
+            return bank
 
     return None
 
 
 def parse_common(body, amount_pattern, description_pattern):
-    amount_match = re.search(amount_pattern, body, re.I)
-    description_match = re.search(description_pattern, body, re.I)
+    amount_match = amount_pattern.search(body)
+    description_match = description_pattern.search(body)
 
     if amount_match and description_match:
         amount = float(amount_match.group(1).replace(',', ''))
         description = description_match.group(1).strip()
         return {'description': description, 'amount': amount}
 
-    if re.search(r'has\s+been\s+reversed|declined|not\s+be\s+completed', body, re.I):
+    if _FAILURE_RE.search(body):
         return None
 
     raise Exception("Unparseable transaction:\n" + body)
 
 
 def parse_cc_transaction(bank, body):
-    parsed = None
-    if bank == "HDFC":
-        parsed = parse_common(body, r'7883\s+for\s+(?:Rs\.?|INR)\s+([\d,]+(\.\d+)?)', r'at\s+(.*?)\s+on')
-    if bank == "ICICI":
-        parsed = parse_common(body, r'transaction\s+of\s+(?:Rs\.?|INR)\s+([\d,]+(\.\d+)?)', r'Info:\s+(.*?)\.')
-    if bank == "HSBC":
-        parsed = parse_common(body, r'been\s+used\s+for\s+(?:Rs\.?|INR)\s+([\d,]+(\.\d+)?)', r'payment to\s+(.*?)\s+on')
-    if bank == "Axis":
-        parsed = parse_common(body, r'9339\s+for\s+(?:Rs\.?|INR)\s+([\d,]+(\.\d+)?)', r'at\s+(.*?)\s+on')
-    if bank == "Federal":
-        parsed = parse_common(body, r'txn\s+of\s+(?:₹|Rs\.?|INR)\s*([\d,]+(\.\d+)?)', r'at\s+(.*?)\s+on')
-    return parsed, "CreditCard"
+    patterns = CC_PATTERNS.get(bank)
+    return (parse_common(body, *patterns) if patterns else None), MODE_CREDIT_CARD
 
 
 def parse_upi_transaction(bank, body):
-    parsed = None
-    if bank == "Federal":
-        parsed = parse_common(body,
-                            r'(?:₹|Rs\.?|INR|\b[A-Z]{3}\b)\s*([\d,]+(\.\d{1,})?)',
-                            r'to\s+(.*?)\.')
-    elif bank == "Kotak":
-        parsed = parse_common(body,
-                            r'Sent\s+(?:₹|Rs\.?|INR|\b[A-Z]{3}\b)(.*?)\s+',
-                            r'to\s+(.*?)on')
-    return parsed, "UPI"
+    patterns = UPI_PATTERNS.get(bank)
+    return (parse_common(body, *patterns) if patterns else None), MODE_UPI
@@ -1,7 +1,10 @@
+from html import escape
+
 from telegram import InlineKeyboardButton
 
 from constants import CALLBACK_CATEGORY_PREFIX, BUTTONS_PER_ROW, BTN_SHARED_EXPENSE, BTN_SOLO_EXPENSE, \
-    CALLBACK_SHARE_NO, CALLBACK_SHARE_YES
+    CALLBACK_SHARE_NO, CALLBACK_SHARE_YES, MSG_TRANSACTION_NOTIFICATION
+from persistence.models import Transaction
 
 # Define constants for expense categories
 EXPENSE_CATEGORIES = [
@@ -10,28 +13,50 @@ EXPENSE_CATEGORIES = [
     "Miscellaneous"
 ]
 
+# Values the importer writes for bank and mode; these contain no HTML special characters
+TRUSTED_BANKS = frozenset({"HDFC", "ICICI", "HSBC", "Axis", "Federal", "Kotak"})
+TRUSTED_MODES = frozenset({"CreditCard", "UPI"})
+
+
+# Category indices grouped into keyboard rows, computed once since the categories are fixed
+CATEGORY_ROW_INDEX_GROUPS = [
+    list(range(start, min(start + BUTTONS_PER_ROW, len(EXPENSE_CATEGORIES))))
+    for start in range(0, len(EXPENSE_CATEGORIES), BUTTONS_PER_ROW)
+]
+
+# Callback data prefixes of the two sharing buttons; only the transaction id varies per keyboard
+SHARE_YES_CALLBACK_PREFIX = f"{CALLBACK_SHARE_YES}_"
+SHARE_NO_CALLBACK_PREFIX = f"{CALLBACK_SHARE_NO}_"
 
-async def get_category_keyboard(transaction_id: str):
-    # Create inline keyboard for expense categories
-    keyboard = []
-    row = []
-    for i, category in enumerate(EXPENSE_CATEGORIES):
-        callback_data = f"{CALLBACK_CATEGORY_PREFIX}{transaction_id}_{i}"
-        row.append(InlineKeyboardButton(category, callback_data=callback_data))
 
-        # 3 buttons per row
-        if (i + 1) % BUTTONS_PER_ROW == 0 or i == len(EXPENSE_CATEGORIES) - 1:
-            keyboard.append(row)
-            row = []
-    return keyboard
+def get_category_keyboard(transaction_id: str):
+    # Create inline keyboard for expense categories, BUTTONS_PER_ROW buttons per row
+    return [
+        [
+            InlineKeyboardButton(EXPENSE_CATEGORIES[i], callback_data=f"{CALLBACK_CATEGORY_PREFIX}{transaction_id}_{i}")
+            for i in row
+        ]
+        for row in CATEGORY_ROW_INDEX_GROUPS
+    ]
 
 
-async def get_sharing_type_keyboard(transaction_id: str):
+def get_sharing_type_keyboard(transaction_id: str):
     # Create keyboard for sharing selection
-    keyboard = [
+    return [
         [
-            InlineKeyboardButton(BTN_SHARED_EXPENSE, callback_data=f"{CALLBACK_SHARE_YES}_{transaction_id}"),
-            InlineKeyboardButton(BTN_SOLO_EXPENSE, callback_data=f"{CALLBACK_SHARE_NO}_{transaction_id}")
+            InlineKeyboardButton(BTN_SHARED_EXPENSE, callback_data=SHARE_YES_CALLBACK_PREFIX + transaction_id),
+            InlineKeyboardButton(BTN_SOLO_EXPENSE, callback_data=SHARE_NO_CALLBACK_PREFIX + transaction_id)
         ]
     ]
-    return keyboard
+
+
+def format_transaction_notification(transaction: Transaction) -> str:
+    # Escape free-form fields only; the amount is a float and bank/mode come from a fixed vocabulary
+    return MSG_TRANSACTION_NOTIFICATION.format(
+        date=escape(transaction.date),
+        time=escape(transaction.time),
+        recipient=escape(transaction.recipient),
+        amount=transaction.amount,
+        bank=transaction.bank if transaction.bank in TRUSTED_BANKS else escape(transaction.bank),
+        mode=transaction.mode if transaction.mode in TRUSTED_MODES else escape(transaction.mode)
+    )
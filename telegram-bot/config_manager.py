@@ -1,9 +1,12 @@
+import asyncio
+import atexit
 import json
 import logging
 import os
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Tuple
 
-from commons.constants import CONFIG_LAST_PROCESSED_ROW, DEFAULT_LAST_PROCESSED_ROW, CONFIG_USER_IDS, DEBANIKS_USER_ID
+from commons.constants import CONFIG_LAST_PROCESSED_ROW, DEFAULT_LAST_PROCESSED_ROW, CONFIG_USER_IDS, DEBANIKS_USER_ID, \
+    CONFIG_FLUSH_DELAY_SECONDS
 
 logger = logging.getLogger(__name__)
 
@@ -14,6 +17,11 @@ class ConfigManager:
         """Initialize config manager with config file path"""
         self.config_file = config_file
         self.config = self._load_config()
+        self._user_ids: Tuple[int, ...] = ()
+        self._cache_user_ids()
+        self._dirty = False
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        atexit.register(self.flush)
 
     def _load_config(self) -> Dict[str, Any]:
         """Load configuration from file or create default"""
@@ -32,11 +40,17 @@ class ConfigManager:
             logger.error(f"Error loading config: {e}")
             return {CONFIG_LAST_PROCESSED_ROW: DEFAULT_LAST_PROCESSED_ROW, CONFIG_USER_IDS: [DEBANIKS_USER_ID]}
 
+    def _cache_user_ids(self) -> None:
+        """Cache the authorized user ids so lookups don't go through the config dict"""
+        self._user_ids = tuple(self.config.get(CONFIG_USER_IDS, []))
+
     def _save_config(self, config: Dict[str, Any]) -> bool:
-        """Save configuration to file"""
+        """Save configuration to file, replacing it atomically so a crash never leaves it half written"""
+        tmp_file = f"{self.config_file}.tmp"
         try:
-            with open(self.config_file, 'w') as f:
+            with open(tmp_file, 'w') as f:
                 json.dump(config, f, indent=2)
+            os.replace(tmp_file, self.config_file)
             return True
         except Exception as e:
             logger.error(f"Error saving config: {e}")
@@ -46,7 +60,42 @@ class ConfigManager:
         """Get the index of the last processed row"""
         return self.config.get(CONFIG_LAST_PROCESSED_ROW, DEFAULT_LAST_PROCESSED_ROW)
 
+    def _schedule_flush(self) -> None:
+        """Coalesce updates made in quick succession into a single write"""
+        if self._flush_handle is not None:
+            return
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop to defer to, write through
+            self.flush()
+            return
+
+        self._flush_handle = loop.call_later(CONFIG_FLUSH_DELAY_SECONDS, self.flush)
+
+    def flush(self) -> bool:
+        """Write pending changes to the config file"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        if not self._dirty:
+            return True
+
+        if not self._save_config(self.config):
+            return False
+
+        self._dirty = False
+        return True
+
     def update_last_processed_row(self, row_index: int) -> bool:
-        """Update the last processed row index"""
+        """Update the last processed row index; the file is written shortly after"""
         self.config[CONFIG_LAST_PROCESSED_ROW] = row_index
-        return self._save_config(self.config)
+        self._dirty = True
+        self._schedule_flush()
+        return True
+
+    def get_user_ids(self) -> Tuple[int, ...]:
+        """Get the authorized user ids in configured order"""
+        return self._user_ids
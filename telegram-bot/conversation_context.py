@@ -1,6 +1,10 @@
-from typing import Optional, Dict, Any
+import asyncio
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, List, Tuple
 
-from constants import CONTEXT_TRANSACTION, CONTEXT_CONVERSATION_STATE, CONTEXT_RELATED_MESSAGE_IDS
+from constants import MAX_OPEN_CONVERSATIONS
 from persistence.models import Transaction
 
 from enum import Enum, auto
@@ -12,64 +16,111 @@ class ConversationState(Enum):
     ENTERING_SHARE_AMOUNT = auto()
 
 
-class ConversationContextManager:
+class ConversationEntry:
+    """State of a single transaction's categorization conversation"""
+    __slots__ = ('transaction', 'state', 'message_ids', 'started_at')
+
+    def __init__(self, transaction: Transaction, state: ConversationState, message_ids: List[int]):
+        self.transaction = transaction
+        self.state = state
+        self.message_ids = message_ids
+        self.started_at = time.monotonic()
+
+
+class ConversationLock:
+    """Lock for one conversation, counting the handlers holding or waiting for it"""
+    __slots__ = ('lock', 'holders')
+
     def __init__(self):
-        self.conversations = {}
+        self.lock = asyncio.Lock()
+        self.holders = 0
 
-    def start_conversation(self, user_id: int, transaction: Transaction, conversation_state: ConversationState) -> None:
-        if not self.conversations.get(user_id):
-            self.conversations[user_id] = {}
 
-        self.conversations[user_id][transaction.transaction_id] = {
-            CONTEXT_TRANSACTION: transaction,
-            CONTEXT_CONVERSATION_STATE: conversation_state,
-            CONTEXT_RELATED_MESSAGE_IDS: []
-        }
+class ConversationContextManager:
+    def __init__(self, max_conversations: int = MAX_OPEN_CONVERSATIONS):
+        # Keyed by (user_id, transaction_id) so every lookup is a single hash, oldest conversation first
+        self.conversations: OrderedDict[Tuple[int, str], ConversationEntry] = OrderedDict()
+        # Conversations users never finish would otherwise pile up; the oldest are dropped past this
+        self.max_conversations = max_conversations
+        # (user_id, message_id) -> transaction id; message ids are only unique within a chat
+        self._message_to_transaction: Dict[Tuple[int, int], str] = {}
+        # Locks of conversations a handler is currently working on
+        self._locks: Dict[Tuple[int, str], ConversationLock] = {}
+
+    @asynccontextmanager
+    async def locked(self, user_id: int, transaction_id: str):
+        """Hold a conversation's lock so updates handled concurrently don't interleave on it"""
+        key = (user_id, transaction_id)
+        conversation_lock = self._locks.get(key)
+        if conversation_lock is None:
+            conversation_lock = self._locks[key] = ConversationLock()
+
+        conversation_lock.holders += 1
+        try:
+            async with conversation_lock.lock:
+                yield
+        finally:
+            conversation_lock.holders -= 1
+            if not conversation_lock.holders:
+                del self._locks[key]
+
+    def start_conversation(self, user_id: int, transaction: Transaction, conversation_state: ConversationState) -> None:
+        self.end_conversation(user_id, transaction.transaction_id)
+        self.conversations[(user_id, transaction.transaction_id)] = ConversationEntry(
+            transaction, conversation_state, []
+        )
+
+        while len(self.conversations) > self.max_conversations:
+            self._drop_oldest_conversation()
+
+    def _drop_oldest_conversation(self) -> None:
+        user_id, transaction_id = next(iter(self.conversations))
+        self.end_conversation(user_id, transaction_id)
+
+    def expire_conversations(self, max_age_seconds: float) -> int:
+        """End conversations started more than max_age_seconds ago, returning how many were ended"""
+        cutoff = time.monotonic() - max_age_seconds
+        expired = 0
+        # Conversations are kept in start order, so the expired ones are all at the front
+        while self.conversations and next(iter(self.conversations.values())).started_at < cutoff:
+            self._drop_oldest_conversation()
+            expired += 1
+        return expired
 
     def update_state(self, user_id: int, transaction_id: str, conversation_state: ConversationState) -> None:
-        if self.conversations.get(user_id) and self.conversations[user_id].get(transaction_id):
-            self.conversations[user_id][transaction_id][CONTEXT_CONVERSATION_STATE] = conversation_state
+        entry = self.conversations.get((user_id, transaction_id))
+        if entry:
+            entry.state = conversation_state
 
     def update_category(self, user_id: int, transaction_id: str, category: str) -> None:
-        if self.conversations.get(user_id) and self.conversations[user_id].get(transaction_id):
-            if not self.conversations[user_id][transaction_id].get(CONTEXT_TRANSACTION):
-                self.conversations[user_id][transaction_id][CONTEXT_TRANSACTION] = Transaction(transaction_id)
-
-            self.conversations[user_id][transaction_id][CONTEXT_TRANSACTION].category = category
+        entry = self.conversations.get((user_id, transaction_id))
+        if entry:
+            entry.transaction.category = category
 
     def update_sharing_status(self, user_id: int, transaction_id: str, is_shared: bool) -> None:
-        if self.conversations.get(user_id) and self.conversations[user_id].get(transaction_id):
-            if not self.conversations[user_id][transaction_id].get(CONTEXT_TRANSACTION):
-                self.conversations[user_id][transaction_id][CONTEXT_TRANSACTION] = Transaction(transaction_id)
-
-            self.conversations[user_id][transaction_id][CONTEXT_TRANSACTION].is_shared = is_shared
+        entry = self.conversations.get((user_id, transaction_id))
+        if entry:
+            entry.transaction.is_shared = is_shared
 
     def update_user_share(self, user_id: int, transaction_id: str, share_amount: float) -> None:
-        if self.conversations.get(user_id) and self.conversations[user_id].get(transaction_id):
-            if not self.conversations[user_id][transaction_id].get(CONTEXT_TRANSACTION):
-                self.conversations[user_id][transaction_id][CONTEXT_TRANSACTION] = Transaction(transaction_id)
-
-            self.conversations[user_id][transaction_id][CONTEXT_TRANSACTION].user_share = share_amount
+        entry = self.conversations.get((user_id, transaction_id))
+        if entry:
+            entry.transaction.user_share = share_amount
 
     def add_message_id_to_conversation_context(self, user_id: int, transaction_id: str, message_id: int):
-        if self.conversations.get(user_id) and self.conversations.get(user_id).get(transaction_id):
-            self.conversations[user_id][transaction_id][CONTEXT_RELATED_MESSAGE_IDS].append(message_id)
-
-    def get_conversation(self, user_id: int, transaction_id: str) -> Optional[Dict[str, Any]]:
-        user_conversations = self.conversations.get(user_id)
-        if user_conversations:
-            return user_conversations.get(transaction_id)
-        return None
-
-    def get_conversations_by_state(self, user_id: int, target_state: ConversationState) -> Optional[Dict[str, Any]]:
-        user_conversations = self.conversations.get(user_id, {})
-        filtered_conversations = {
-            txn_id: data
-            for txn_id, data in user_conversations.items()
-            if data.get(CONTEXT_CONVERSATION_STATE) == target_state
-        }
-        return filtered_conversations
+        entry = self.conversations.get((user_id, transaction_id))
+        if entry:
+            entry.message_ids.append(message_id)
+            self._message_to_transaction[(user_id, message_id)] = transaction_id
+
+    def get_transaction_id_for_message(self, user_id: int, message_id: int) -> Optional[str]:
+        return self._message_to_transaction.get((user_id, message_id))
+
+    def get_conversation(self, user_id: int, transaction_id: str) -> Optional[ConversationEntry]:
+        return self.conversations.get((user_id, transaction_id))
 
     def end_conversation(self, user_id: int, transaction_id: str) -> None:
-        if self.conversations.get(user_id) and self.conversations.get(user_id).get(transaction_id):
-            del self.conversations[user_id][transaction_id]
+        entry = self.conversations.pop((user_id, transaction_id), None)
+        if entry:
+            for message_id in entry.message_ids:
+                self._message_to_transaction.pop((user_id, message_id), None)
@@ -1,18 +1,18 @@
+import asyncio
+import functools
 import logging
-from html import escape
 
 from telegram import Update, InlineKeyboardMarkup, ForceReply
 from telegram.error import TelegramError
 from telegram.ext import CallbackContext, ContextTypes
 
-from bot_utils import get_category_keyboard, get_sharing_type_keyboard, EXPENSE_CATEGORIES
+from bot_utils import get_category_keyboard, get_sharing_type_keyboard, EXPENSE_CATEGORIES, \
+    format_transaction_notification
 from constants import (
-    CONTEXT_TRANSACTION, CONTEXT_RELATED_MESSAGE_IDS,
     MSG_CATEGORY_SELECTED, MSG_TRANSACTION_NOT_FOUND, MSG_CONTEXT_NOT_FOUND,
     MSG_SHARED_EXPENSE, MSG_INVALID_SHARE_NEGATIVE, MSG_INVALID_SHARE_EXCEEDS_TOTAL,
     MSG_INVALID_AMOUNT_FORMAT, MSG_TRANSACTION_UPDATED, MSG_TRANSACTION_UPDATE_FAILED,
-    MSG_ERROR, SHARED_TYPE, SOLO_TYPE, CALLBACK_SHARE_YES, HTML_PARSE_MODE,
-    MSG_TRANSACTION_NOTIFICATION
+    MSG_ERROR, SHARED_TYPE, SOLO_TYPE, CALLBACK_SHARE_YES, CALLBACK_CATEGORY_PREFIX, HTML_PARSE_MODE
 )
 from conversation_context import ConversationContextManager, ConversationState
 from persistence.models import Transaction
@@ -21,6 +21,19 @@ from persistence.persistence_wrapper import PersistenceWrapper
 logger = logging.getLogger(__name__)
 
 
+def answers_callback_query(handler):
+    """Acknowledge the button press concurrently with the handler instead of waiting on it first"""
+    @functools.wraps(handler)
+    async def wrapper(self, update: Update, context: CallbackContext) -> None:
+        answer = asyncio.create_task(update.callback_query.answer())
+        try:
+            await handler(self, update, context)
+        finally:
+            await answer
+
+    return wrapper
+
+
 class ConversationStateMachine:
     """Handles the conversation flow for transaction categorization and processing"""
 
@@ -37,6 +50,7 @@ class ConversationStateMachine:
         self.bot = bot
         self.persistence_wrapper = persistence_wrapper
         self.conversation_context_manager = conversation_context_manager
+
     async def send_transaction_notification(self, transaction: Transaction, user_id: int) -> None:
         """
         Send a notification about a new transaction and start the categorization flow
@@ -47,16 +61,9 @@ class ConversationStateMachine:
         """
         try:
             # Format the transaction message
-            message = MSG_TRANSACTION_NOTIFICATION.format(
-                date=escape(transaction.date),
-                time=escape(transaction.time),
-                recipient=escape(transaction.recipient),
-                amount=escape(str(transaction.amount)),
-                bank=escape(transaction.bank),
-                mode=escape(transaction.mode)
-            )
+            message = format_transaction_notification(transaction)
 
-            keyboard = await get_category_keyboard(transaction.transaction_id)
+            keyboard = get_category_keyboard(transaction.transaction_id)
 
             reply_markup = InlineKeyboardMarkup(keyboard)
 
@@ -69,120 +76,124 @@ class ConversationStateMachine:
                 )
                 self.conversation_context_manager.start_conversation(user_id, transaction,
                                                                      ConversationState.SELECTING_CATEGORY)
-            except TelegramError as e:
-                logger.error(f"Failed to send message to user {user_id}: {e}")
+            except TelegramError:
+                logger.exception("Failed to send message to user %s", user_id)
 
-        except Exception as e:
-            logger.error(f"Error sending transaction notification: {e}")
+        except Exception:
+            logger.exception("Error sending transaction notification")
 
+    @answers_callback_query
     async def category_selected(self, update: Update, context: CallbackContext) -> None:
         """Handle category selection and ask about sharing"""
         query = update.callback_query
-        await query.answer()
 
         # Extract transaction id from callback data (cat_{transaction_id}_{category_index})
-        parts = query.data.split("_")
+        transaction_id, _, category_index = query.data[len(CALLBACK_CATEGORY_PREFIX):].rpartition("_")
+        # Check the payload up front rather than letting int() or the category lookup raise
+        if not transaction_id or not category_index.isdecimal() or int(category_index) >= len(EXPENSE_CATEGORIES):
+            logger.warning("Ignoring malformed category callback data: %s", query.data)
+            return
         user_id = update.effective_user.id
-        transaction_id = parts[1]
 
-        try:
-            # get conversation context
-            conversation = self.conversation_context_manager.get_conversation(user_id, transaction_id)
+        async with self.conversation_context_manager.locked(user_id, transaction_id):
+            try:
+                # get conversation context
+                conversation = self.conversation_context_manager.get_conversation(user_id, transaction_id)
 
-            if not conversation:
-                await query.edit_message_text(
-                    text=MSG_TRANSACTION_NOT_FOUND,
-                    reply_markup=None
-                )
-                return
+                if not conversation:
+                    await query.edit_message_text(
+                        text=MSG_TRANSACTION_NOT_FOUND,
+                        reply_markup=None
+                    )
+                    return
 
-            # Extract category index from callback data
-            category = EXPENSE_CATEGORIES[int(parts[2])]
+                # Extract category index from callback data
+                category = EXPENSE_CATEGORIES[int(category_index)]
 
-            # Update context with selected category
-            self.conversation_context_manager.update_category(user_id, transaction_id, category)
+                # Update context with selected category
+                self.conversation_context_manager.update_category(user_id, transaction_id, category)
 
-            keyboard = await get_sharing_type_keyboard(transaction_id)
-            reply_markup = InlineKeyboardMarkup(keyboard)
+                keyboard = get_sharing_type_keyboard(transaction_id)
+                reply_markup = InlineKeyboardMarkup(keyboard)
 
-            await query.edit_message_text(
-                text=MSG_CATEGORY_SELECTED.format(category=category),
-                parse_mode=HTML_PARSE_MODE,
-                reply_markup=reply_markup
-            )
+                await query.edit_message_text(
+                    text=MSG_CATEGORY_SELECTED.format(category=category),
+                    parse_mode=HTML_PARSE_MODE,
+                    reply_markup=reply_markup
+                )
 
-            self.conversation_context_manager.update_state(user_id, transaction_id,
-                                                           ConversationState.SELECTING_SHARING_TYPE)
-            return
-        except Exception as e:
-            logger.error(f"Error in category selection: {e}")
-            await query.edit_message_text(
-                text=MSG_ERROR.format(error=str(e)),
-                reply_markup=None
-            )
+                self.conversation_context_manager.update_state(user_id, transaction_id,
+                                                               ConversationState.SELECTING_SHARING_TYPE)
+                return
+            except Exception as e:
+                logger.exception("Error in category selection")
+                await query.edit_message_text(
+                    text=MSG_ERROR.format(error=str(e)),
+                    reply_markup=None
+                )
 
-        self.conversation_context_manager.end_conversation(user_id, transaction_id)
+            self.conversation_context_manager.end_conversation(user_id, transaction_id)
 
+    @answers_callback_query
     async def sharing_type_selected(self, update: Update, context: CallbackContext) -> None:
         """Handle sharing type selection"""
         query = update.callback_query
-        await query.answer()
 
-        try:
-            # Extract transaction id from callback data (share.yes_{transaction_id})
-            parts = query.data.split("_")
-            share_mode = parts[0]
-            transaction_id = parts[1]
-            user_id = update.effective_user.id
-            conversation = self.conversation_context_manager.get_conversation(user_id, transaction_id)
-
-            if not conversation:
-                await query.edit_message_text(
-                    text=MSG_CONTEXT_NOT_FOUND,
-                    reply_markup=None
-                )
-                return
-
-            # Get the sharing selection
-            is_shared = share_mode == CALLBACK_SHARE_YES
-
-            # Update context with sharing status
-            self.conversation_context_manager.update_sharing_status(user_id, transaction_id, is_shared)
+        # Extract transaction id from callback data (share.yes_{transaction_id})
+        share_mode, _, transaction_id = query.data.partition("_")
+        user_id = update.effective_user.id
 
-            if is_shared:
-                # Ask for user's share
-                transaction: Transaction = conversation[CONTEXT_TRANSACTION]
-                total_amount = transaction.amount
+        async with self.conversation_context_manager.locked(user_id, transaction_id):
+            try:
+                conversation = self.conversation_context_manager.get_conversation(user_id, transaction_id)
+
+                if not conversation:
+                    await query.edit_message_text(
+                        text=MSG_CONTEXT_NOT_FOUND,
+                        reply_markup=None
+                    )
+                    return
+
+                # Get the sharing selection
+                is_shared = share_mode == CALLBACK_SHARE_YES
+
+                # Update context with sharing status
+                self.conversation_context_manager.update_sharing_status(user_id, transaction_id, is_shared)
+
+                if is_shared:
+                    # Ask for user's share
+                    transaction: Transaction = conversation.transaction
+                    total_amount = transaction.amount
+                    await query.edit_message_text(
+                        text=MSG_SHARED_EXPENSE.format(amount=total_amount),
+                        parse_mode=HTML_PARSE_MODE
+                    )
+
+                    message = await self.bot.send_message(
+                        chat_id=query.message.chat.id,
+                        text="Enter your share amount for this transaction:",
+                        reply_markup=ForceReply(selective=True),
+                        parse_mode=HTML_PARSE_MODE,
+                        reply_to_message_id=query.message.message_id
+                    )
+
+                    # Store the message_id to match replies later
+                    self.conversation_context_manager.add_message_id_to_conversation_context(
+                        user_id, transaction_id, message.message_id
+                    )
+                    self.conversation_context_manager.update_state(
+                        user_id, transaction_id, ConversationState.ENTERING_SHARE_AMOUNT
+                    )
+                else:
+                    # Complete the transaction as solo expense
+                    await self.complete_transaction(update, user_id, transaction_id)
+
+            except Exception as e:
+                logger.exception("Error in sharing type selection")
                 await query.edit_message_text(
-                    text=MSG_SHARED_EXPENSE.format(amount=total_amount),
-                    parse_mode=HTML_PARSE_MODE
-                )
-
-                message = await self.bot.send_message(
-                    chat_id=query.message.chat.id,
-                    text="Enter your share amount for this transaction:",
-                    reply_markup=ForceReply(selective=True),
-                    parse_mode=HTML_PARSE_MODE,
-                    reply_to_message_id=query.message.message_id
-                )
-
-                # Store the message_id to match replies later
-                self.conversation_context_manager.add_message_id_to_conversation_context(
-                    user_id, transaction_id, message.message_id
-                )
-                self.conversation_context_manager.update_state(
-                    user_id, transaction_id, ConversationState.ENTERING_SHARE_AMOUNT
+                    text=MSG_ERROR.format(error=str(e)),
+                    reply_markup=None
                 )
-            else:
-                # Complete the transaction as solo expense
-                await self.complete_transaction(update, user_id, transaction_id)
-
-        except Exception as e:
-            logger.error(f"Error in sharing type selection: {e}")
-            await query.edit_message_text(
-                text=MSG_ERROR.format(error=str(e)),
-                reply_markup=None
-            )
 
     async def share_amount_entered(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle user entering their share amount"""
@@ -193,46 +204,51 @@ class ConversationStateMachine:
         user_id = message.from_user.id
         reply_to_message_id = message.reply_to_message.message_id
 
-        # Find the conversation that is waiting for this reply
-        conversations_waiting_for_share_amount = self.conversation_context_manager.get_conversations_by_state(
-            user_id, ConversationState.ENTERING_SHARE_AMOUNT
-        )
-
-        if not conversations_waiting_for_share_amount:
-            return
-
         # get the transaction id behind the message to which this is a reply
-        matching_transaction_id = next(
-            (transaction_id for transaction_id, data in conversations_waiting_for_share_amount.items()
-             if reply_to_message_id in data.get(CONTEXT_RELATED_MESSAGE_IDS)),
-            None
+        matching_transaction_id = self.conversation_context_manager.get_transaction_id_for_message(
+            user_id, reply_to_message_id
         )
-
         if not matching_transaction_id:
             return
 
-        # Validate the share amount
-        try:
-            share_amount = float(message.text.strip())
-            conversation = conversations_waiting_for_share_amount.get(matching_transaction_id)
-            total_amount = float(conversation[CONTEXT_TRANSACTION].amount)
-
-            if share_amount < 0:
-                sent_message = await update.message.reply_text(
-                    MSG_INVALID_SHARE_NEGATIVE,
-                    reply_markup=ForceReply(selective=True)
-                )
-                self.conversation_context_manager.add_message_id_to_conversation_context(
-                    user_id, matching_transaction_id, sent_message.message_id
-                )
+        async with self.conversation_context_manager.locked(user_id, matching_transaction_id):
+            # Only the conversation that is waiting for a share amount accepts the reply
+            conversation = self.conversation_context_manager.get_conversation(user_id, matching_transaction_id)
+            if not conversation or conversation.state != ConversationState.ENTERING_SHARE_AMOUNT:
                 return
 
-            if share_amount > total_amount:
+            # Validate the share amount
+            try:
+                # Tolerate a leading currency symbol and thousands separators in the reply
+                share_amount = float(message.text.strip().lstrip("₹$ ").replace(",", ""))
+                total_amount = conversation.transaction.amount
+
+                if share_amount < 0:
+                    sent_message = await update.message.reply_text(
+                        MSG_INVALID_SHARE_NEGATIVE,
+                        reply_markup=ForceReply(selective=True)
+                    )
+                    self.conversation_context_manager.add_message_id_to_conversation_context(
+                        user_id, matching_transaction_id, sent_message.message_id
+                    )
+                    return
+
+                if share_amount > total_amount:
+                    sent_message = await update.message.reply_text(
+                        MSG_INVALID_SHARE_EXCEEDS_TOTAL.format(
+                            share=share_amount,
+                            total=total_amount
+                        ),
+                        reply_markup=ForceReply(selective=True)
+                    )
+                    self.conversation_context_manager.add_message_id_to_conversation_context(
+                        user_id, matching_transaction_id, sent_message.message_id
+                    )
+                    return
+
+            except ValueError:
                 sent_message = await update.message.reply_text(
-                    MSG_INVALID_SHARE_EXCEEDS_TOTAL.format(
-                        share=share_amount,
-                        total=total_amount
-                    ),
+                    MSG_INVALID_AMOUNT_FORMAT,
                     reply_markup=ForceReply(selective=True)
                 )
                 self.conversation_context_manager.add_message_id_to_conversation_context(
@@ -240,34 +256,29 @@ class ConversationStateMachine:
                 )
                 return
 
-        except ValueError:
-            sent_message = await update.message.reply_text(
-                MSG_INVALID_AMOUNT_FORMAT,
-                reply_markup=ForceReply(selective=True)
-            )
-            self.conversation_context_manager.add_message_id_to_conversation_context(
-                user_id, matching_transaction_id, sent_message.message_id
-            )
-            return
-
-        self.conversation_context_manager.update_user_share(user_id, matching_transaction_id, share_amount)
-        await self.complete_transaction(update, user_id, matching_transaction_id)
+            self.conversation_context_manager.update_user_share(user_id, matching_transaction_id, share_amount)
+            await self.complete_transaction(update, user_id, matching_transaction_id)
 
     async def complete_transaction(self, update: Update, user_id: int, transaction_id: str) -> None:
         """Complete the transaction processing and update the sheet"""
         conversation = self.conversation_context_manager.get_conversation(user_id, transaction_id)
+        # Solo expenses complete from a button press, shared ones from the share amount reply
+        query = update.callback_query
 
         if not conversation:
-            if hasattr(update, 'message'):
+            if update.message:
                 await update.message.reply_text(MSG_CONTEXT_NOT_FOUND)
             return
 
         try:
-            transaction = conversation[CONTEXT_TRANSACTION]
-            transaction.user_share = transaction.amount if not transaction.is_shared else transaction.user_share
+            transaction = conversation.transaction
+            is_shared = transaction.is_shared
+            if not is_shared:
+                # A solo expense is borne entirely by the user
+                transaction.user_share = transaction.amount
 
             # Log to persistence store
-            success = self.persistence_wrapper.write_transaction(transaction)
+            success = await self.persistence_wrapper.write_transaction(transaction)
 
             if success:
                 message = MSG_TRANSACTION_UPDATED.format(
@@ -276,15 +287,15 @@ class ConversationStateMachine:
                     recipient=transaction.recipient,
                     amount=transaction.amount,
                     category=transaction.category,
-                    type=SHARED_TYPE if transaction.is_shared else SOLO_TYPE,
+                    type=SHARED_TYPE if is_shared else SOLO_TYPE,
                     share_info=transaction.user_share
                 )
             else:
                 message = MSG_TRANSACTION_UPDATE_FAILED
 
             # Send confirmation message
-            if hasattr(update, 'callback_query') and update.callback_query:
-                await update.callback_query.edit_message_text(
+            if query:
+                await query.edit_message_text(
                     text=message,
                     parse_mode=HTML_PARSE_MODE
                 )
@@ -295,11 +306,11 @@ class ConversationStateMachine:
                 )
 
         except Exception as e:
-            logger.error(f"Error completing transaction: {e}")
+            logger.exception("Error completing transaction")
             error_message = MSG_ERROR.format(error=str(e))
 
-            if hasattr(update, 'callback_query') and update.callback_query:
-                await update.callback_query.edit_message_text(text=error_message)
+            if query:
+                await query.edit_message_text(text=error_message)
             else:
                 await update.message.reply_text(text=error_message)
 
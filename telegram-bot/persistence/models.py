@@ -2,10 +2,10 @@ from dataclasses import dataclass
 from typing import Dict, Optional
 
 from constants import KEY_TRANSACTION_ID, KEY_DATE, KEY_TIME, KEY_RECIPIENT, KEY_AMOUNT, KEY_BANK, KEY_MODE, \
-    KEY_CATEGORY, KEY_IS_SHARED, KEY_USER_SHARE
+    KEY_CATEGORY, KEY_IS_SHARED, KEY_USER_SHARE, YES_VALUE
 
 
-@dataclass
+@dataclass(slots=True)
 class Transaction:
     transaction_id: str
     date: Optional[str] = None
@@ -20,18 +20,23 @@ class Transaction:
 
     @classmethod
     def from_dict(cls, transaction_dict: Dict[str, str]):
-        if not transaction_dict.get(KEY_TRANSACTION_ID):
+        transaction_id = transaction_dict.get(KEY_TRANSACTION_ID)
+        if not transaction_id:
             raise ValueError("Transaction id must be present")
 
+        amount = transaction_dict.get(KEY_AMOUNT)
+        user_share = transaction_dict.get(KEY_USER_SHARE)
+
         return cls(
-            transaction_id=transaction_dict[KEY_TRANSACTION_ID],
+            transaction_id=transaction_id,
             date=transaction_dict.get(KEY_DATE),
             time=transaction_dict.get(KEY_TIME),
             recipient=transaction_dict.get(KEY_RECIPIENT),
-            amount=float(transaction_dict.get(KEY_AMOUNT)) if transaction_dict.get(KEY_AMOUNT) else 0.0,
+            amount=float(amount) if amount else 0.0,
             bank=transaction_dict.get(KEY_BANK),
             mode=transaction_dict.get(KEY_MODE),
             category=transaction_dict.get(KEY_CATEGORY),
-            is_shared=bool(transaction_dict.get(KEY_IS_SHARED)) if transaction_dict.get(KEY_IS_SHARED) else False,
-            user_share=float(transaction_dict.get(KEY_USER_SHARE)) if transaction_dict.get(KEY_USER_SHARE) else 0.0
+            # Sheets store the flag as Yes/No, and bool("No") is True
+            is_shared=transaction_dict.get(KEY_IS_SHARED) == YES_VALUE,
+            user_share=float(user_share) if user_share else 0.0
         )
@@ -1,17 +1,72 @@
 import asyncio
+import io
 import logging
-from contextlib import closing
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Any, List, Optional, Tuple, Callable, Awaitable
 
 import firebase_admin
 import psycopg2
 from dotenv import load_dotenv
 from firebase_admin import firestore
-from psycopg2 import sql
+from google.api_core import exceptions as google_exceptions
+from google.api_core.retry import Retry, if_exception_type
+from psycopg2.extras import Json
+from psycopg2.pool import ThreadedConnectionPool
 
 from commons.google_sheets_manager import GoogleSheetsManager
 from persistence.models import Transaction
 
 TRANSACTIONS_COLLECTION_NAME = 'transactions'
+# Firestore rejects batched writes with more than 500 operations
+FIRESTORE_BATCH_LIMIT = 500
+# Batches committed at once; more in flight tends to end in DEADLINE_EXCEEDED
+FIRESTORE_MAX_CONCURRENT_COMMITS = 10
+FIRESTORE_COMMIT_RETRY = Retry(predicate=if_exception_type(
+    google_exceptions.Aborted, google_exceptions.DeadlineExceeded, google_exceptions.ServiceUnavailable
+))
+POSTGRES_POOL_MIN_CONNECTIONS = 1
+POSTGRES_POOL_MAX_CONNECTIONS = 10
+# Batches at least this large are loaded with COPY through a staging table instead of one JSON parameter
+POSTGRES_COPY_THRESHOLD = 100
+
+TRANSACTION_UPSERT_QUERY = """
+    INSERT INTO transactions (
+        transaction_id,
+        date,
+        time,
+        recipient,
+        amount,
+        bank,
+        mode,
+        category,
+        is_shared,
+        user_share
+    ) {source}
+    ON CONFLICT (transaction_id) DO UPDATE SET
+        date = EXCLUDED.date,
+        time = EXCLUDED.time,
+        recipient = EXCLUDED.recipient,
+        amount = EXCLUDED.amount,
+        bank = EXCLUDED.bank,
+        mode = EXCLUDED.mode,
+        category = EXCLUDED.category,
+        is_shared = EXCLUDED.is_shared,
+        user_share = EXCLUDED.user_share;
+"""
+TRANSACTION_COLUMNS = (
+    'transaction_id', 'date', 'time', 'recipient', 'amount',
+    'bank', 'mode', 'category', 'is_shared', 'user_share'
+)
+STAGING_TABLE_NAME = 'transactions_stage'
+PREPARED_UPSERT_NAME = 'transaction_upsert'
+# Transactions buffered per secondary store before new writes to it are dropped
+SECONDARY_WRITE_QUEUE_SIZE = 10_000
+# Most queued transactions handed to a store's batch writer at once
+SECONDARY_WRITE_BATCH_SIZE = 500
+# Reviewed transactions remembered to skip writing identical data again
+WRITTEN_TRANSACTIONS_CACHE_SIZE = 10_000
 
 load_dotenv()
 
@@ -19,29 +74,82 @@ logger = logging.getLogger(__name__)
 
 class FireBaseManager:
     def __init__(self, creds):
-        # Initialize Firebase app
-        firebase_admin.initialize_app(creds)
-        self.db = firestore.client()
+        # Initialize the default Firebase app once; constructing another manager reuses it
+        try:
+            app = firebase_admin.get_app()
+        except ValueError:
+            app = firebase_admin.initialize_app(creds)
+        self.db = firestore.client(app)
+        self._collection = self.db.collection(TRANSACTIONS_COLLECTION_NAME)
+
+    @staticmethod
+    def _to_document(transaction: Transaction) -> Dict[str, Any]:
+        return {
+            'date': transaction.date,
+            'time': transaction.time,
+            'recipient': transaction.recipient,
+            'amount': transaction.amount,
+            'bank': transaction.bank,
+            'mode': transaction.mode,
+            'category': transaction.category,
+            'is_shared': transaction.is_shared,
+            'user_share': transaction.user_share
+        }
 
     async def write_transaction(self, transaction: Transaction) -> bool:
         try:
-            self.db.collection(TRANSACTIONS_COLLECTION_NAME).document(transaction.transaction_id).set({
-                'date': transaction.date,
-                'time': transaction.time,
-                'recipient': transaction.recipient,
-                'amount': transaction.amount,
-                'bank': transaction.bank,
-                'mode': transaction.mode,
-                'category': transaction.category,
-                'is_shared': transaction.is_shared,
-                'user_share': transaction.user_share
-            })
+            document = self._collection.document(transaction.transaction_id)
+            await asyncio.to_thread(document.set, self._to_document(transaction))
+
+            return True
+        except Exception as e:
+            logger.error(f"Error writing transaction {transaction.transaction_id} to Firestore: {e}")
+            return False
+
+    def _commit_batch(self, transactions: List[Transaction]) -> None:
+        batch = self.db.batch()
+        for transaction in transactions:
+            batch.set(self._collection.document(transaction.transaction_id), self._to_document(transaction))
+        batch.commit(retry=FIRESTORE_COMMIT_RETRY)
+
+    async def write_transactions(self, transactions: List[Transaction]) -> bool:
+        """Write transactions in batches of FIRESTORE_BATCH_LIMIT, committing several batches concurrently"""
+        # A commit may not write the same document twice, keep the latest version of each transaction
+        transactions = list({t.transaction_id: t for t in transactions}.values())
+        semaphore = asyncio.Semaphore(FIRESTORE_MAX_CONCURRENT_COMMITS)
+
+        async def commit(chunk: List[Transaction]) -> None:
+            async with semaphore:
+                await asyncio.to_thread(self._commit_batch, chunk)
+
+        try:
+            await asyncio.gather(*(
+                commit(transactions[start:start + FIRESTORE_BATCH_LIMIT])
+                for start in range(0, len(transactions), FIRESTORE_BATCH_LIMIT)
+            ))
 
             return True
         except Exception as e:
+            logger.error(f"Error writing {len(transactions)} transactions to Firestore: {e}")
             return False
 
 
+class PreparingConnectionPool(ThreadedConnectionPool):
+    """Thread-safe connection pool that runs a setup statement on each connection it opens"""
+
+    def __init__(self, minconn: int, maxconn: int, *args, setup_statement: str, **kwargs):
+        # Set before the base initializer, which opens the first minconn connections
+        self._setup_statement = setup_statement
+        super().__init__(minconn, maxconn, *args, **kwargs)
+
+    def _connect(self, key=None):
+        conn = super()._connect(key)
+        with conn.cursor() as cursor:
+            cursor.execute(self._setup_statement)
+        conn.commit()
+        return conn
+
+
 class PostgresManager:
     def __init__(self, db_config):
         """
@@ -53,34 +161,48 @@ class PostgresManager:
         - port
         """
         self.db_config = db_config
+        self._pool: Optional[PreparingConnectionPool] = None
+        # Writes run in worker threads, guard the lazy pool creation
+        self._pool_lock = threading.Lock()
+        columns = ", ".join(TRANSACTION_COLUMNS)
+        # Single-row writes are the common case, parse and plan them once per connection
+        parameters = ", ".join(f"${position}" for position in range(1, len(TRANSACTION_COLUMNS) + 1))
+        self._prepare_single_upsert = f"PREPARE {PREPARED_UPSERT_NAME} AS " + TRANSACTION_UPSERT_QUERY.format(
+            source=f"VALUES ({parameters})")
+        # Statements are plain strings: there are no identifiers to compose, so psycopg2 skips a render pass
+        self._single_upsert = f"EXECUTE {PREPARED_UPSERT_NAME} ({', '.join(['%s'] * len(TRANSACTION_COLUMNS))})"
+        # The whole batch goes in as one JSON parameter expanded with the table's own row type, so the
+        # statement is planned once however many rows it carries
+        self._batch_upsert = TRANSACTION_UPSERT_QUERY.format(
+            source=f"SELECT {columns} FROM jsonb_populate_recordset(NULL::transactions, %s)")
+        self._staged_upsert = TRANSACTION_UPSERT_QUERY.format(source=f"SELECT {columns} FROM {STAGING_TABLE_NAME}")
+        self._create_staging_table = (
+            f"CREATE TEMP TABLE {STAGING_TABLE_NAME} (LIKE transactions INCLUDING DEFAULTS) ON COMMIT DROP")
+        self._copy_to_staging_table = f"COPY {STAGING_TABLE_NAME} ({columns}) FROM STDIN WITH (FORMAT text)"
 
-    async def write_transaction(self, transaction) -> bool:
-        insert_query = sql.SQL("""
-            INSERT INTO transactions (
-                transaction_id,
-                date,
-                time,
-                recipient,
-                amount,
-                bank,
-                mode,
-                category,
-                is_shared,
-                user_share
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT (transaction_id) DO UPDATE SET
-                date = EXCLUDED.date,
-                time = EXCLUDED.time,
-                recipient = EXCLUDED.recipient,
-                amount = EXCLUDED.amount,
-                bank = EXCLUDED.bank,
-                mode = EXCLUDED.mode,
-                category = EXCLUDED.category,
-                is_shared = EXCLUDED.is_shared,
-                user_share = EXCLUDED.user_share;
-        """)
-
-        values = (
+    def _get_pool(self) -> PreparingConnectionPool:
+        # Created on first use so the bot can start while Postgres is unreachable
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = PreparingConnectionPool(POSTGRES_POOL_MIN_CONNECTIONS, POSTGRES_POOL_MAX_CONNECTIONS,
+                                                     self.db_config, setup_statement=self._prepare_single_upsert)
+            return self._pool
+
+    @contextmanager
+    def _connection(self):
+        """Borrow a pooled connection; the transaction commits on success and rolls back on error"""
+        pool = self._get_pool()
+        conn = pool.getconn()
+        try:
+            with conn:
+                yield conn
+        finally:
+            # Don't hand a broken connection back to the pool
+            pool.putconn(conn, close=bool(conn.closed))
+
+    @staticmethod
+    def _to_row(transaction: Transaction) -> Tuple:
+        return (
             transaction.transaction_id,
             transaction.date,
             transaction.time,
@@ -93,38 +215,184 @@ class PostgresManager:
             transaction.user_share
         )
 
+    @staticmethod
+    def _to_copy_value(value) -> str:
+        """Encode a value for COPY's text format"""
+        if value is None:
+            return r'\N'
+        if isinstance(value, bool):
+            return 't' if value else 'f'
+        return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+    @staticmethod
+    def _latest_rows(transactions: List[Transaction]) -> List[Tuple]:
+        # A statement can't upsert the same row twice, keep the latest version of each transaction
+        return list({t.transaction_id: PostgresManager._to_row(t) for t in transactions}.values())
+
+    # psycopg2 blocks, so the statements run in worker threads and the async methods only await them
+
+    def _upsert_row(self, row: Tuple) -> None:
+        with self._connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(self._single_upsert, row)
+
+    def _upsert_rows(self, rows: List[Tuple]) -> None:
+        records = [dict(zip(TRANSACTION_COLUMNS, row)) for row in rows]
+        with self._connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(self._batch_upsert, (Json(records),))
+
+    def _copy_rows(self, buffer: io.StringIO) -> None:
+        with self._connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(self._create_staging_table)
+                cursor.copy_expert(self._copy_to_staging_table, buffer)
+                cursor.execute(self._staged_upsert)
+
+    async def write_transaction(self, transaction) -> bool:
+        try:
+            await asyncio.to_thread(self._upsert_row, self._to_row(transaction))
+            return True
+        except Exception as e:
+            logger.error(f"Error writing transaction {transaction.transaction_id} to Postgres: {e}")
+            return False
+
+    async def write_transactions(self, transactions: List[Transaction]) -> bool:
+        """Upsert transactions with a single statement, picking the cheapest path for the batch size"""
+        rows = self._latest_rows(transactions)
+        if len(rows) >= POSTGRES_COPY_THRESHOLD:
+            return await self.copy_transactions(transactions)
+
+        try:
+            if len(rows) == 1:
+                await asyncio.to_thread(self._upsert_row, rows[0])
+            else:
+                await asyncio.to_thread(self._upsert_rows, rows)
+            return True
+        except Exception as e:
+            logger.error(f"Error writing {len(transactions)} transactions to Postgres: {e}")
+            return False
+
+    async def copy_transactions(self, transactions: List[Transaction]) -> bool:
+        """Bulk upsert for large loads: COPY into a temporary staging table, then upsert from it"""
+        buffer = io.StringIO()
+        for row in self._latest_rows(transactions):
+            buffer.write('\t'.join(self._to_copy_value(value) for value in row))
+            buffer.write('\n')
+        buffer.seek(0)
+
         try:
-            with closing(psycopg2.connect(self.db_config)) as conn:
-                with conn.cursor() as cursor:
-                    cursor.execute(insert_query, values)
-                    conn.commit()
+            await asyncio.to_thread(self._copy_rows, buffer)
             return True
         except Exception as e:
-            # Optionally log e here
+            logger.error(f"Error copying {len(transactions)} transactions to Postgres: {e}")
             return False
 
 
 class PersistenceWrapper:
-    def __init__(self, firebase_manager: FireBaseManager, postgres_manager: PostgresManager, sheet_manager: GoogleSheetsManager):
+    def __init__(self, firebase_manager: Optional[FireBaseManager], postgres_manager: Optional[PostgresManager],
+                 sheet_manager: GoogleSheetsManager):
+        """The sheet is always written; Firebase and Postgres only when a manager is configured for them"""
         self.firebase_manager = firebase_manager
         self.postgres_manager = postgres_manager
         self.sheet_manager = sheet_manager
 
-    def write_transaction(self, transaction) -> bool:
-        success = True
-        try:
-            self.sheet_manager.add_reviewed_transaction(transaction)
-        except Exception as e:
-            logger.error(f"Error writing to Google Sheets: {e}")
-            success = False
+        # Stores written in the background, each drained by its own long-lived worker
+        self._secondary_writers: List[Callable[[List[Transaction]], Awaitable[bool]]] = [
+            manager.write_transactions for manager in (firebase_manager, postgres_manager) if manager is not None
+        ]
+        self._queues: List[asyncio.Queue] = []
+        self._workers: List[asyncio.Task] = []
+        # Transaction id -> reviewed fields last written, least recently written first
+        self._written: OrderedDict[str, Tuple] = OrderedDict()
+        # Sheet writes waiting for the one in flight to finish, and the task writing them
+        self._pending_sheet_writes: List[Tuple[Transaction, asyncio.Future]] = []
+        self._sheet_writer: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        """Start the background writers; must be called from the running event loop"""
+        for write_batch in self._secondary_writers:
+            queue = asyncio.Queue(maxsize=SECONDARY_WRITE_QUEUE_SIZE)
+            self._queues.append(queue)
+            self._workers.append(asyncio.create_task(self._drain(queue, write_batch)))
+
+    async def stop(self) -> None:
+        """Wait for queued writes to finish, then stop the background writers"""
+        for queue in self._queues:
+            await queue.join()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._queues.clear()
+        self._workers.clear()
+
+    @staticmethod
+    async def _drain(queue: asyncio.Queue, write_batch: Callable[[List[Transaction]], Awaitable[bool]]) -> None:
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < SECONDARY_WRITE_BATCH_SIZE and not queue.empty():
+                batch.append(queue.get_nowait())
+
+            try:
+                if not await write_batch(batch):
+                    logger.error(f"Failed to write {len(batch)} transactions to secondary store")
+            except Exception as e:
+                logger.error(f"Error writing {len(batch)} transactions to secondary store: {e}")
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+    async def _write_to_sheet(self, transaction: Transaction) -> bool:
+        """
+        Append the transaction to the reviewed sheet
+
+        A write made while the sheet is idle goes out immediately. Writes that arrive while one is in
+        flight are coalesced and sent together in a single append when it finishes.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending_sheet_writes.append((transaction, future))
+        if self._sheet_writer is None or self._sheet_writer.done():
+            self._sheet_writer = asyncio.create_task(self._flush_sheet_writes())
+        return await future
+
+    async def _flush_sheet_writes(self) -> None:
+        while self._pending_sheet_writes:
+            batch, self._pending_sheet_writes = self._pending_sheet_writes, []
+            try:
+                # gspread is synchronous, keep its network I/O off the event loop
+                success = await asyncio.to_thread(self.sheet_manager.add_reviewed_transactions,
+                                                  [transaction for transaction, _ in batch])
+            except Exception as e:
+                logger.error(f"Error writing to Google Sheets: {e}")
+                success = False
+
+            # A single append either lands every row or none of them
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(success)
+
+    async def write_transaction(self, transaction) -> bool:
+        """Write the transaction to the sheet, then queue it for the secondary stores; succeeds if the sheet write does"""
+        reviewed_fields = (transaction.amount, transaction.category, transaction.is_shared, transaction.user_share)
+        if self._written.get(transaction.transaction_id) == reviewed_fields:
+            # Same review as last time, writing it again would only append a duplicate row
+            return True
+
+        success = await self._write_to_sheet(transaction)
+        if not success:
+            logger.error(f"Error writing transaction {transaction.transaction_id} to Google Sheets")
+            return False
 
-        # Fire-and-forget async calls
-        def fire_and_forget(fn, *args):
-            loop = asyncio.get_event_loop()
-            loop.create_task(fn(*args))
+        self._written[transaction.transaction_id] = reviewed_fields
+        self._written.move_to_end(transaction.transaction_id)
+        if len(self._written) > WRITTEN_TRANSACTIONS_CACHE_SIZE:
+            self._written.popitem(last=False)
 
-        # Fire async tasks for Firebase and Postgres without awaiting them
-        # fire_and_forget(self.firebase_manager.write_transaction, transaction)
-        # fire_and_forget(self.postgres_manager.write_transaction, transaction)
+        # Secondary stores only mirror reviews the sheet accepted, a failed write is retried by the user
+        for queue in self._queues:
+            try:
+                queue.put_nowait(transaction)
+            except asyncio.QueueFull:
+                logger.error(f"Secondary write queue full, dropping transaction {transaction.transaction_id}")
 
-        return success
\ No newline at end of file
+        return True
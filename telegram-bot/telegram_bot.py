@@ -1,16 +1,15 @@
 #!/usr/bin/env python
+import asyncio
 import logging
 import os
-import traceback
-from html import escape
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 from dotenv import load_dotenv
 from firebase_admin import credentials
 # Telegram Bot imports
-from telegram import Update, InlineKeyboardMarkup
-from telegram.error import TelegramError
+from telegram import Update
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     CommandHandler,
     CallbackContext,
@@ -19,9 +18,8 @@ from telegram.ext import (
     filters
 )
 
-from bot_utils import get_category_keyboard
 from commons.google_sheets_manager import GoogleSheetsManager
-from conversation_context import ConversationContextManager, ConversationState
+from conversation_context import ConversationContextManager
 from conversation_state_machine import ConversationStateMachine
 from env import FIREBASE_CREDENTIALS_PATH
 from persistence.models import Transaction
@@ -34,9 +32,11 @@ from config_manager import ConfigManager
 from commons.constants import ENV_TELEGRAM_TOKEN, ENV_SHEET_ID, ENV_SHEET_NAME, \
     CMD_START, CMD_CHECK, CALLBACK_CATEGORY_PREFIX, \
     CALLBACK_SHARE_PREFIX, MSG_START, MSG_CHECKING, \
-    MSG_NO_TRANSACTIONS, MSG_FOUND_TRANSACTIONS, MSG_TRANSACTION_NOTIFICATION, \
-    MSG_ERROR, CONFIG_USER_IDS, \
-    CHECK_INTERVAL_SECONDS, FIRST_CHECK_DELAY_SECONDS, HTML_PARSE_MODE, ENV_SHEET_NAME_POST_REVIEW, ENV_POSTGRES_CONNECTION_STRING
+    MSG_NO_TRANSACTIONS, MSG_FOUND_TRANSACTIONS, \
+    MSG_ERROR, \
+    CHECK_INTERVAL_SECONDS, MAX_CHECK_INTERVAL_SECONDS, FIRST_CHECK_DELAY_SECONDS, HTML_PARSE_MODE, CONVERSATION_TTL_SECONDS, \
+    CONVERSATION_SWEEP_INTERVAL_SECONDS, ENV_SHEET_NAME_POST_REVIEW, ENV_POSTGRES_CONNECTION_STRING, \
+    ENV_WEBHOOK_URL, ENV_WEBHOOK_SECRET, ENV_WEBHOOK_PORT, WEBHOOK_LISTEN_ADDRESS, DEFAULT_WEBHOOK_PORT, WEBHOOK_URL_PATH
 
 # Configure logging
 logging.basicConfig(
@@ -61,11 +61,25 @@ class TelegramBot:
             gsheets_manager: Sheet monitor instance
             config_manager: Config manager instance
         """
-        self.application = Application.builder().token(token).build()
+        self.application = (
+            Application.builder()
+            .token(token)
+            # Handle updates from different users and conversations concurrently
+            .concurrent_updates(True)
+            # Keep concurrent sends under Telegram's flood limits and retry when asked to back off
+            .rate_limiter(AIORateLimiter())
+            .post_init(self._post_init)
+            .post_shutdown(self._post_shutdown)
+            .build()
+        )
         self.sheet_monitor = gsheets_manager
         self.config_manager = config_manager
         self.conversation_context_manager = ConversationContextManager()
         self.persistence_wrapper = persistence_wrapper
+        # Delay before the next periodic check, backed off while the sheet stays unchanged
+        self._check_interval = CHECK_INTERVAL_SECONDS
+        # Serializes reading, fetching past and advancing the last processed row
+        self._check_lock = asyncio.Lock()
 
         # Create transaction handler
         self.state_machine = ConversationStateMachine(
@@ -76,6 +90,13 @@ class TelegramBot:
 
         self._setup_handlers()
 
+    async def _post_init(self, application: Application) -> None:
+        # Background persistence workers need the application's event loop
+        await self.persistence_wrapper.start()
+
+    async def _post_shutdown(self, application: Application) -> None:
+        await self.persistence_wrapper.stop()
+
     def _setup_handlers(self) -> None:
         """Set up message and callback handlers"""
 
@@ -123,7 +144,7 @@ class TelegramBot:
                     MSG_FOUND_TRANSACTIONS.format(count=len(new_transactions))
                 )
         except Exception as e:
-            logger.error(f"Error checking updates: {e}")
+            logger.exception("Error checking updates")
             await update.message.reply_text(MSG_ERROR.format(error=str(e)))
 
     async def check_for_updates(self) -> List[Dict[str, str]]:
@@ -133,70 +154,47 @@ class TelegramBot:
         Returns:
             List of new transactions
         """
-        last_processed_row = self.config_manager.get_last_processed_row()
-        new_transactions, new_last_row = self.sheet_monitor.get_new_rows(last_processed_row)
+        # A /check and the periodic check can run concurrently; without the lock both would read the
+        # same cursor across the await below and notify the same rows twice
+        async with self._check_lock:
+            last_processed_row = self.config_manager.get_last_processed_row()
+            # gspread blocks on network I/O, keep the event loop serving other updates meanwhile
+            new_transactions, new_last_row = await asyncio.to_thread(self.sheet_monitor.get_new_rows,
+                                                                     last_processed_row)
+            if new_transactions:
+                self.config_manager.update_last_processed_row(new_last_row)
 
         if new_transactions:
-            self.config_manager.update_last_processed_row(new_last_row)
-
-            # Process each new transaction
-            for index, transaction in enumerate(new_transactions):
-                transaction = Transaction.from_dict(transaction)
-                # todo fix this
-                user_id = self.config_manager.config.get(CONFIG_USER_IDS, [])[0]
-                await self.state_machine.send_transaction_notification(transaction, user_id)
-
-        return new_transactions
-
-    async def send_transaction_notification(self, transaction: Transaction) -> None:
-        """
-        Send a notification about a new transaction and start the categorization flow
-
-        Args:
-            transaction: Transaction details
-        """
-        try:
-            # Format the transaction message
-            message = MSG_TRANSACTION_NOTIFICATION.format(
-                date=escape(transaction.date),
-                time=escape(transaction.time),
-                recipient=escape(transaction.recipient),
-                amount=escape(str(transaction.amount)),
-                bank=escape(transaction.bank),
-                mode=escape(transaction.mode)
-            )
-
-            keyboard = await get_category_keyboard(transaction.transaction_id)
+            # More transactions tend to follow, go back to checking often
+            self._check_interval = CHECK_INTERVAL_SECONDS
 
-            reply_markup = InlineKeyboardMarkup(keyboard)
-
-            # Send to all authorized users
-            for user_id in self.config_manager.config.get(CONFIG_USER_IDS, []):
+            # Parse every row up front; a malformed one is skipped rather than failing the whole batch,
+            # since the cursor has already moved past all of them
+            transactions = []
+            for row in new_transactions:
                 try:
-                    await self.application.bot.send_message(
-                        chat_id=user_id,
-                        text=message,
-                        reply_markup=reply_markup,
-                        parse_mode=HTML_PARSE_MODE
-                    )
-                    self.conversation_context_manager.start_conversation(user_id, transaction,
-                                                                        ConversationState.SELECTING_CATEGORY)
-                except TelegramError as e:
-                    logger.error(f"Failed to send message to user {user_id}: {e}")
+                    transactions.append(Transaction.from_dict(row))
+                except ValueError:
+                    logger.exception("Skipping malformed transaction row %s", row)
+
+            # todo fix this
+            user_id = self.config_manager.get_user_ids()[0]
+            # Notify about every new transaction concurrently rather than one round-trip at a time
+            await asyncio.gather(*(
+                self.state_machine.send_transaction_notification(transaction, user_id)
+                for transaction in transactions
+            ))
 
-        except Exception as e:
-            logger.error(f"Error sending transaction notification: {e}")
+        return new_transactions
 
     @staticmethod
     async def error_handler(update: object, context: CallbackContext) -> None:
         """Handle errors in the dispatcher"""
-        logger.error(f"Exception while handling an update: {context.error}")
-        tb_list = traceback.format_exception(None, context.error, context.error.__traceback__)
-        tb_string = ''.join(tb_list)
-        logger.error(f"Traceback: {tb_string}")
+        logger.error("Exception while handling an update", exc_info=context.error)
 
         # Notify user
-        if update and hasattr(update, 'effective_chat'):
+        # Errors from jobs have no update, and not every update has a chat
+        if isinstance(update, Update) and update.effective_chat:
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
                 text="An error occurred. Please try again later."
@@ -207,13 +205,41 @@ class TelegramBot:
         logger.info("Starting bot polling...")
         self.application.run_polling()
 
+    def run_webhook(self, webhook_url: str, port: int, secret_token: Optional[str] = None) -> None:
+        """
+        Start the bot in webhook mode, with Telegram pushing updates to webhook_url
+
+        Args:
+            webhook_url: Public HTTPS base URL that forwards to this process
+            port: Local port to listen on
+            secret_token: Secret Telegram sends with every update so forged requests are rejected
+        """
+        logger.info("Starting bot webhook...")
+        self.application.run_webhook(
+            listen=WEBHOOK_LISTEN_ADDRESS,
+            port=port,
+            url_path=WEBHOOK_URL_PATH,
+            webhook_url=f"{webhook_url.rstrip('/')}/{WEBHOOK_URL_PATH}",
+            secret_token=secret_token
+        )
+
     async def periodic_check_task(self, context: CallbackContext) -> None:
         """Periodic task to check for new transactions"""
         logger.info("Running periodic check for new transactions...")
         try:
-            await self.check_for_updates()
-        except Exception as e:
-            logger.error(f"Error in periodic check: {e}")
+            if not await self.check_for_updates():
+                self._check_interval = min(self._check_interval * 2, MAX_CHECK_INTERVAL_SECONDS)
+        except Exception:
+            logger.exception("Error in periodic check")
+        finally:
+            # Each check schedules the next, so checks never overlap and the interval can vary
+            context.job_queue.run_once(self.periodic_check_task, when=self._check_interval)
+
+    async def expire_conversations_task(self, context: CallbackContext) -> None:
+        """Periodic task to drop conversations users abandoned"""
+        expired = self.conversation_context_manager.expire_conversations(CONVERSATION_TTL_SECONDS)
+        if expired:
+            logger.info("Expired %d abandoned conversations", expired)
 
 
 def main():
@@ -229,24 +255,44 @@ def main():
             os.environ.get(ENV_SHEET_NAME_POST_REVIEW)
         )
         config_manager = ConfigManager(TELEGRAM_BOT_CONFIG_FILE_NAME)
-        fire_base_manager = FireBaseManager(credentials.Certificate(FIREBASE_CREDENTIALS_PATH))
-        postgres_manager = PostgresManager(os.environ.get(ENV_POSTGRES_CONNECTION_STRING))
+        # Secondary stores are optional, only write to the ones that are configured
+        fire_base_manager = None
+        if os.path.exists(FIREBASE_CREDENTIALS_PATH):
+            fire_base_manager = FireBaseManager(credentials.Certificate(FIREBASE_CREDENTIALS_PATH))
+        else:
+            logger.info("No Firebase credentials found, not writing transactions to Firestore")
+
+        postgres_manager = None
+        postgres_connection_string = os.environ.get(ENV_POSTGRES_CONNECTION_STRING)
+        if postgres_connection_string:
+            # Connects on first write, so an unreachable database doesn't block startup
+            postgres_manager = PostgresManager(postgres_connection_string)
+        else:
+            logger.info("No Postgres connection string set, not writing transactions to Postgres")
+
         persistence_wrapper = PersistenceWrapper(fire_base_manager, postgres_manager, gsheets_manager)
 
         # Create and start the bot
         bot = TelegramBot(token, gsheets_manager, config_manager, persistence_wrapper)
 
-        # Schedule periodic checks (every 5 minutes)
+        # Schedule periodic checks, every CHECK_INTERVAL_SECONDS up to MAX_CHECK_INTERVAL_SECONDS when idle
         job_queue = bot.application.job_queue
-        job_queue.run_repeating(bot.periodic_check_task, interval=CHECK_INTERVAL_SECONDS,
-                                first=FIRST_CHECK_DELAY_SECONDS)
-
-        # Start the bot
-        bot.run_polling()
+        job_queue.run_once(bot.periodic_check_task, when=FIRST_CHECK_DELAY_SECONDS)
+        job_queue.run_repeating(bot.expire_conversations_task, interval=CONVERSATION_SWEEP_INTERVAL_SECONDS)
+
+        # Start the bot; use a webhook when a public URL is configured, otherwise poll
+        webhook_url = os.environ.get(ENV_WEBHOOK_URL)
+        if webhook_url:
+            bot.run_webhook(
+                webhook_url,
+                int(os.environ.get(ENV_WEBHOOK_PORT, DEFAULT_WEBHOOK_PORT)),
+                os.environ.get(ENV_WEBHOOK_SECRET)
+            )
+        else:
+            bot.run_polling()
 
-    except Exception as e:
-        logger.error(f"Fatal error: {e}")
-        traceback.print_exc()
+    except Exception:
+        logger.exception("Fatal error")
 
 
 if __name__ == "__main__":